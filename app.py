@@ -1,15 +1,47 @@
-from flask import Flask, render_template, flash, redirect, url_for, session, request, jsonify
+from flask import Flask, render_template, flash, redirect, url_for, session, request, g, has_request_context, stream_with_context
 from flask_cors import CORS
-from flask_mysqldb import MySQL
-from wtforms import Form, StringField, TextAreaField, SelectField, PasswordField, DecimalField, IntegerField, FieldList, FormField, validators
+import click
+import MySQLdb
+import MySQLdb.cursors
+from wtforms import Form, StringField, TextAreaField, SelectField, PasswordField, DecimalField, validators
 from passlib.hash import sha256_crypt
 from functools import wraps
 
 from dotenv import load_dotenv
 import os
 
+import atexit
+import base64
+import bisect
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import datetime
 import decimal
+import gzip
+import hashlib
+import io
+import json
+import queue
+import re
+import threading
+import time
+import uuid
 import flask.json
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
 
 class CustomJSONEncoder(flask.json.JSONEncoder):
     # To make sure that decimals get converted to strings before JSON'd
@@ -19,8 +51,349 @@ class CustomJSONEncoder(flask.json.JSONEncoder):
         return super(CustomJSONEncoder, self).default(obj)
 
 
-app = Flask(__name__)
-CORS(app, supports_credentials=True) # allow for cross-site requests from the storefront
+# JSON backend for every JSON response -- orjson when it's installed, else the stdlib encoder above.
+# Both produce the same bytes as flask.jsonify: Decimals as strings, dates in HTTP format, compact unless pretty printing.
+JSON_BACKEND = os.environ.get('API_JSON_BACKEND', 'orjson' if orjson is not None else 'json')
+
+
+def orjson_default(obj):
+    # the types orjson doesn't handle itself, converted the way CustomJSONEncoder / flask's encoder do it
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    if isinstance(obj, datetime.datetime):
+        return http_date(obj.utctimetuple())
+    if isinstance(obj, datetime.date):
+        return http_date(obj.timetuple())
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if hasattr(obj, "__html__"):
+        return str(obj.__html__())
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps_json(data):
+    # -> response body bytes, newline terminated like flask.jsonify
+    pretty = app.config['JSONIFY_PRETTYPRINT_REGULAR'] or app.debug
+    if JSON_BACKEND == 'orjson' and orjson is not None and not pretty:
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_APPEND_NEWLINE
+        if app.config['JSON_SORT_KEYS']:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            body = orjson.dumps(data, default=orjson_default, option=option)
+        except TypeError: # orjson.JSONEncodeError -- non-str keys, huge ints; the stdlib encoder copes with those
+            body = None
+        # orjson always writes UTF-8, flask escapes non-ASCII by default -- anything non-ASCII goes through the stdlib encoder
+        if body is not None and (body.isascii() or not app.config['JSON_AS_ASCII']):
+            return body
+    if pretty:
+        text = flask.json.dumps(data, indent=2, separators=(", ", ": "))
+    else:
+        text = flask.json.dumps(data, separators=(",", ":"))
+    return (text + "\n").encode("utf-8")
+
+
+def jsonify(*args, **kwargs):
+    # drop-in for flask.jsonify on top of dumps_json
+    if args and kwargs:
+        raise TypeError("jsonify() behavior undefined when passed both args and kwargs")
+    data = args[0] if len(args) == 1 else args or kwargs
+    return app.response_class(dumps_json(data), mimetype=app.config['JSONIFY_MIMETYPE'])
+
+
+class JSONFlask(Flask):
+    # dicts returned from views (and error handlers) go through our jsonify instead of flask's
+    def make_response(self, rv):
+        if isinstance(rv, dict):
+            rv = jsonify(rv)
+        elif isinstance(rv, tuple) and rv and isinstance(rv[0], dict):
+            rv = (jsonify(rv[0]),) + rv[1:]
+        return super().make_response(rv)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    # Bounded, thread-safe pool of MySQLdb connections.
+    # Idle connections are pinged on checkout and closed once they're older than max_lifetime seconds.
+    def __init__(self, connect, size, max_lifetime, timeout):
+        self._connect = connect
+        self.size = size
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = collections.deque()
+        self._created = {}
+        self.stats = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "connections_created": 0,
+            "connections_recycled": 0,
+            "health_check_failures": 0
+        }
+
+    def checkout(self):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.stats["timeouts"] += 1
+            raise PoolTimeout("Timed out waiting for a database connection.")
+        waited = time.monotonic() - start
+        with self._lock:
+            self.stats["checkouts"] += 1
+            self.stats["wait_seconds_total"] += waited
+            self.stats["wait_seconds_max"] = max(self.stats["wait_seconds_max"], waited)
+        try:
+            return self._healthy_connection()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def checkin(self, conn):
+        try:
+            conn.rollback() # drop anything the request left uncommitted
+        except MySQLdb.Error:
+            self._discard(conn)
+        else:
+            with self._lock:
+                self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    def discard(self, conn):
+        # for a connection that broke while checked out -- closes it instead of returning it to the idle list
+        self._discard(conn)
+        self._slots.release()
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats, size=self.size, idle=len(self._idle))
+
+    def _healthy_connection(self):
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = self._connect()
+                with self._lock:
+                    self._created[id(conn)] = time.monotonic()
+                    self.stats["connections_created"] += 1
+                return conn
+            if time.monotonic() - self._created.get(id(conn), 0) > self.max_lifetime:
+                self._discard(conn)
+                with self._lock:
+                    self.stats["connections_recycled"] += 1
+                continue
+            try:
+                conn.ping()
+                return conn
+            except MySQLdb.Error:
+                self._discard(conn)
+                with self._lock:
+                    self.stats["health_check_failures"] += 1
+
+    def _discard(self, conn):
+        with self._lock:
+            self._created.pop(id(conn), None)
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+
+
+# MySQL client error codes for a replica that can't be reached or dropped the connection
+REPLICA_CONNECTION_ERRORS = (2003, 2006, 2013)
+
+
+class ReplicaHealth:
+    # Whether reads may go to the replica. A failure takes it out of rotation for retry_after seconds, doubling up to
+    # max_retry_after while it keeps failing. Replication lag is checked at most every check_interval seconds.
+    def __init__(self, retry_after, max_retry_after, check_interval, max_lag):
+        self.retry_after = retry_after
+        self.max_retry_after = max_retry_after
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self._lock = threading.Lock()
+        self._down_until = 0
+        self._backoff = retry_after
+        self._checked_at = 0
+        self.stats = {"failures": 0, "fallbacks": 0, "lag_seconds": -1}
+
+    def available(self):
+        with self._lock:
+            return time.monotonic() >= self._down_until
+
+    def failed(self):
+        with self._lock:
+            self.stats["failures"] += 1
+            self._down_until = time.monotonic() + self._backoff
+            self._backoff = min(self._backoff * 2, self.max_retry_after)
+
+    def succeeded(self):
+        with self._lock:
+            self._backoff = self.retry_after
+
+    def fell_back(self):
+        with self._lock:
+            self.stats["fallbacks"] += 1
+
+    def check_due(self):
+        # True for one caller every check_interval seconds
+        with self._lock:
+            if time.monotonic() - self._checked_at < self.check_interval:
+                return False
+            self._checked_at = time.monotonic()
+            return True
+
+    def lag_ok(self, status):
+        # status is the SHOW SLAVE STATUS row -- a server that isn't replicating (a local stand-in) has none and counts as healthy,
+        # a replica whose SQL thread stopped reports a NULL lag and doesn't
+        if not status:
+            return True
+        lag = status.get("Seconds_Behind_Master")
+        with self._lock:
+            self.stats["lag_seconds"] = -1 if lag is None else lag
+        return lag is not None and lag <= self.max_lag
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats, available=int(time.monotonic() >= self._down_until))
+
+
+class PooledMySQL:
+    # Stands in for flask_mysqldb.MySQL: mysql.connection is checked out of the pool the first time
+    # it's used in an app context and handed back at teardown, so the routes don't change.
+    def __init__(self, app=None):
+        self.app = None
+        self.pool = None
+        self.replica_pool = None
+        self.replica_health = None
+        self._pool_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('MYSQL_HOST', 'localhost')
+        app.config.setdefault('MYSQL_USER', None)
+        app.config.setdefault('MYSQL_PASSWORD', None)
+        app.config.setdefault('MYSQL_DB', None)
+        app.config.setdefault('MYSQL_PORT', 3306)
+        app.config.setdefault('MYSQL_CHARSET', 'utf8')
+        app.config.setdefault('MYSQL_CURSORCLASS', None)
+        app.config.setdefault('MYSQL_POOL_SIZE', 10)
+        app.config.setdefault('MYSQL_POOL_MAX_LIFETIME', 3600)
+        app.config.setdefault('MYSQL_POOL_TIMEOUT', 10)
+        # optional read replica -- same user, password and database as the primary
+        app.config.setdefault('MYSQL_REPLICA_HOST', None)
+        app.config.setdefault('MYSQL_REPLICA_PORT', app.config['MYSQL_PORT'])
+        app.config.setdefault('MYSQL_REPLICA_MAX_LAG', 30)
+        app.config.setdefault('MYSQL_REPLICA_RETRY', 5)
+        app.config.setdefault('MYSQL_REPLICA_RETRY_MAX', 300)
+        app.config.setdefault('MYSQL_REPLICA_CHECK_INTERVAL', 10)
+        self.replica_health = ReplicaHealth(app.config['MYSQL_REPLICA_RETRY'], app.config['MYSQL_REPLICA_RETRY_MAX'],
+                                            app.config['MYSQL_REPLICA_CHECK_INTERVAL'], app.config['MYSQL_REPLICA_MAX_LAG'])
+        app.teardown_appcontext(self.teardown)
+
+    def connect(self, replica=False):
+        config = self.app.config
+        kwargs = {
+            "host": config['MYSQL_REPLICA_HOST'] if replica else config['MYSQL_HOST'],
+            "port": config['MYSQL_REPLICA_PORT'] if replica else config['MYSQL_PORT'],
+            "use_unicode": True,
+            "charset": config['MYSQL_CHARSET']
+        }
+        if config['MYSQL_USER']:
+            kwargs['user'] = config['MYSQL_USER']
+        if config['MYSQL_PASSWORD']:
+            kwargs['passwd'] = config['MYSQL_PASSWORD']
+        if config['MYSQL_DB']:
+            kwargs['db'] = config['MYSQL_DB']
+        if config['MYSQL_CURSORCLASS']:
+            kwargs['cursorclass'] = getattr(MySQLdb.cursors, config['MYSQL_CURSORCLASS'])
+        return MySQLdb.connect(**kwargs)
+
+    def get_pool(self, replica=False):
+        # built lazily so every gunicorn worker gets its own pool after the fork
+        with self._pool_lock:
+            config = self.app.config
+            if replica:
+                if self.replica_pool is None:
+                    self.replica_pool = ConnectionPool(lambda: self.connect(replica=True), config['MYSQL_POOL_SIZE'],
+                                                       config['MYSQL_POOL_MAX_LIFETIME'], config['MYSQL_POOL_TIMEOUT'])
+                return self.replica_pool
+            if self.pool is None:
+                self.pool = ConnectionPool(self.connect, config['MYSQL_POOL_SIZE'],
+                                           config['MYSQL_POOL_MAX_LIFETIME'], config['MYSQL_POOL_TIMEOUT'])
+            return self.pool
+
+    @property
+    def connection(self):
+        if 'mysql_db' not in g:
+            g.mysql_db = self.get_pool().checkout()
+        return g.mysql_db
+
+    @property
+    def has_replica(self):
+        return bool(self.app.config['MYSQL_REPLICA_HOST'])
+
+    @property
+    def replica_connection(self):
+        # this app context's replica connection, or None when there's no replica or it's out of rotation -- read from the primary then
+        if not self.has_replica:
+            return None
+        if 'mysql_replica_db' not in g:
+            if not self.replica_health.available():
+                return None
+            pool = self.get_pool(replica=True)
+            try:
+                conn = pool.checkout()
+            except PoolTimeout:
+                return None
+            except MySQLdb.Error:
+                self.replica_health.failed()
+                return None
+            if self.replica_health.check_due() and not self.replica_health.lag_ok(self.replica_status(conn)):
+                pool.checkin(conn)
+                self.replica_health.failed()
+                return None
+            self.replica_health.succeeded()
+            g.mysql_replica_db = conn
+        return g.mysql_replica_db
+
+    def replica_status(self, conn):
+        try:
+            cur = conn.cursor(MySQLdb.cursors.DictCursor)
+            try:
+                cur.execute("SHOW SLAVE STATUS")
+                return cur.fetchone()
+            finally:
+                cur.close()
+        except MySQLdb.OperationalError: # no REPLICATION CLIENT privilege, nothing to go on
+            return None
+
+    def replica_failed(self):
+        # the replica connection broke mid-request -- drop it and take the replica out of rotation
+        conn = g.pop('mysql_replica_db', None)
+        if conn is not None:
+            self.replica_pool.discard(conn)
+        self.replica_health.failed()
+
+    def teardown(self, exception):
+        conn = g.pop('mysql_db', None)
+        if conn is not None:
+            self.pool.checkin(conn)
+        conn = g.pop('mysql_replica_db', None)
+        if conn is not None:
+            self.replica_pool.checkin(conn)
+
+
+app = JSONFlask(__name__)
+CORS(app, supports_credentials=True, expose_headers=['X-Next-Cursor']) # allow for cross-site requests from the storefront
 app.json_encoder = CustomJSONEncoder
 
 load_dotenv() # to use local env variables when building
@@ -29,12 +402,675 @@ app.config['MYSQL_USER'] = os.environ.get('API_USER')
 app.config['MYSQL_PASSWORD'] = os.environ.get('API_PASSWORD')
 app.config['MYSQL_DB'] = os.environ.get('API_DB')
 app.config['MYSQL_CURSORCLASS'] = 'DictCursor'
+app.config['MYSQL_POOL_SIZE'] = int(os.environ.get('API_POOL_SIZE', 10))
+app.config['MYSQL_POOL_MAX_LIFETIME'] = int(os.environ.get('API_POOL_MAX_LIFETIME', 3600))
+app.config['MYSQL_POOL_TIMEOUT'] = float(os.environ.get('API_POOL_TIMEOUT', 10))
+# Optional read replica for storefront reads. Any second MySQL server will do for local testing, e.g. API_REPLICA_PORT=3307
+# on 127.0.0.1 seeded the same way as the primary -- a server that isn't replicating is treated as having no lag.
+app.config['MYSQL_REPLICA_HOST'] = os.environ.get('API_REPLICA_HOST')
+app.config['MYSQL_REPLICA_PORT'] = int(os.environ.get('API_REPLICA_PORT', 3306))
+app.config['MYSQL_REPLICA_MAX_LAG'] = int(os.environ.get('API_REPLICA_MAX_LAG', 30))
 app.config['SECRET_KEY'] = os.environ.get('API_SECRET_KEY')
 
-mysql = MySQL(app)
+mysql = PooledMySQL(app)
+
+
+@app.errorhandler(PoolTimeout)
+def pool_timeout(error):
+    return {"errorText": "Server is busy, please try again."}, 503
+
+
+# Request-scoped DB session -- routes get cursors from db_cursor() and commit through db_session().commit().
+# Anything still open when the app context tears down is closed (and logged), along with the query count if it looks like N+1.
+QUERY_COUNT_WARNING = int(os.environ.get('API_QUERY_COUNT_WARNING', 20))
+
+# Reads by a session that wrote in the last REPLICA_STICKY_SECONDS go to the primary -- keep it above the usual replication lag
+REPLICA_STICKY_SECONDS = float(os.environ.get('API_REPLICA_STICKY_SECONDS', 5))
+# After an admin write invalidates the catalog or category table, reloads stay on the primary for this long: a replica is
+# still used while it is up to MYSQL_REPLICA_MAX_LAG behind, and a load that misses the write is cached for the whole TTL
+REPLICA_CACHE_HOLD_SECONDS = max(REPLICA_STICKY_SECONDS, app.config['MYSQL_REPLICA_MAX_LAG'])
+
+# Opt-in SQL profiling -- times every query and commit, logs the slow ones and feeds the per-endpoint numbers on /metrics
+SQL_PROFILING = os.environ.get('API_SQL_PROFILING') == '1'
+SLOW_QUERY_MS = float(os.environ.get('API_SLOW_QUERY_MS', 200))
+METRICS_SAMPLE_SIZE = int(os.environ.get('API_METRICS_SAMPLE_SIZE', 1000))
+
+
+def normalize_sql(query):
+    # one line, with IN lists and CASE arms collapsed so the same statement logs the same way whatever the batch size
+    query = re.sub(r"\s+", " ", query).strip()
+    query = re.sub(r"\(\s*%s(?:\s*,\s*%s)+\s*\)", "(...)", query)
+    return re.sub(r"(?: WHEN %s THEN %s)+", " WHEN ... THEN ...", query)
+
+
+class SessionCursor:
+    # wraps a MySQLdb cursor so the session can count its queries and rows and close it if the route didn't
+    # a replica cursor whose connection drops is reopened on the primary and the query rerun there
+    def __init__(self, db, cursor, cursorclass=None, on_replica=False):
+        self._db = db
+        self._cursor = cursor
+        self._cursorclass = cursorclass
+        self.on_replica = on_replica
+        self.closed = False
+
+    def _run(self, method, query, args):
+        self._db.query_count += 1
+        if not SQL_PROFILING:
+            return method(query, args)
+        start = time.perf_counter()
+        try:
+            return method(query, args)
+        finally:
+            self._db.record_query(query, time.perf_counter() - start)
+
+    def execute(self, query, args=None):
+        try:
+            return self._run(self._cursor.execute, query, args)
+        except MySQLdb.OperationalError as error:
+            if not self.on_replica or error.args[0] not in REPLICA_CONNECTION_ERRORS:
+                raise
+            self._cursor = self._db.fail_over(self._cursor, self._cursorclass)
+            self.on_replica = False
+            return self._run(self._cursor.execute, query, args)
+
+    def executemany(self, query, args):
+        return self._run(self._cursor.executemany, query, args)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._db.rows_fetched += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany()
+        self._db.rows_fetched += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._db.rows_fetched += len(rows)
+        return rows
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._cursor.close()
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DBSession:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.cursors = []
+        self.query_count = 0
+        self.commit_count = 0
+        self.rows_fetched = 0
+        self.db_seconds = 0.0
+        self.after_commit = [] # callbacks run once the current transaction commits, dropped on rollback
+
+    def cursor(self, server_side=False, replica=False):
+        # server_side cursors are unbuffered -- rows come off the wire as they're fetched, and must all be read (or the cursor closed) before the next query
+        # replica cursors read from the replica when one is configured and usable, see replica_connection
+        cursorclass = MySQLdb.cursors.SSDictCursor if server_side else None
+        conn = self.replica_connection() if replica else None
+        if conn is not None:
+            cur = SessionCursor(self, conn.cursor(cursorclass), cursorclass, on_replica=True)
+        else:
+            cur = SessionCursor(self, mysql.connection.cursor(cursorclass))
+        self.cursors.append(cur)
+        return cur
+
+    def replica_connection(self):
+        # read-your-writes: once this request has committed, or the session's last write is under REPLICA_STICKY_SECONDS old,
+        # reads stay on the primary so they can't miss a write the replica hasn't applied yet
+        if not mysql.has_replica:
+            return None
+        if self.commit_count or (has_request_context() and time.time() - session.get('db_last_write', 0) < REPLICA_STICKY_SECONDS):
+            return None
+        conn = mysql.replica_connection
+        if conn is None:
+            mysql.replica_health.fell_back()
+        return conn
+
+    def fail_over(self, cursor, cursorclass):
+        try:
+            cursor.close()
+        except MySQLdb.Error:
+            pass
+        mysql.replica_failed()
+        mysql.replica_health.fell_back()
+        return mysql.connection.cursor(cursorclass)
+
+    def commit(self):
+        start = time.perf_counter()
+        mysql.connection.commit()
+        self.commit_count += 1
+        if SQL_PROFILING:
+            self.db_seconds += time.perf_counter() - start
+        if mysql.has_replica and has_request_context():
+            session['db_last_write'] = time.time()
+        callbacks, self.after_commit = self.after_commit, []
+        for callback in callbacks:
+            callback()
+
+    def record_query(self, query, elapsed):
+        self.db_seconds += elapsed
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            app.logger.warning("Slow query (%.1f ms) in %s: %s", elapsed * 1000, self.endpoint, normalize_sql(query))
+
+    def rollback(self):
+        mysql.connection.rollback()
+        self.after_commit = []
+
+    def close(self):
+        # returns how many cursors were left open
+        leaked = [cur for cur in self.cursors if not cur.closed]
+        for cur in leaked:
+            cur.close()
+        return len(leaked)
+
+
+def db_session():
+    if 'db_session' not in g:
+        g.db_session = DBSession(request.endpoint if has_request_context() else None)
+    return g.db_session
+
+
+def db_cursor(server_side=False, replica=False):
+    # use as "with db_cursor() as cur:" so the cursor closes when the block ends
+    # storefront reads pass replica=True, anything that writes (or reads to decide a write) stays on the primary
+    return db_session().cursor(server_side, replica)
+
+
+class EndpointMetrics:
+    # per-endpoint totals for /metrics, latency quantiles come from the last sample_size requests
+    def __init__(self, sample_size):
+        self.sample_size = sample_size
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, duration, db):
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = {
+                    "requests": 0,
+                    "duration_seconds": 0.0,
+                    "db_seconds": 0.0,
+                    "queries": 0,
+                    "rows": 0,
+                    "commits": 0,
+                    "durations": collections.deque(maxlen=self.sample_size),
+                    "db_durations": collections.deque(maxlen=self.sample_size)
+                }
+            stats["requests"] += 1
+            stats["duration_seconds"] += duration
+            stats["durations"].append(duration)
+            db_seconds = db.db_seconds if db else 0.0
+            stats["db_seconds"] += db_seconds
+            stats["db_durations"].append(db_seconds)
+            if db:
+                stats["queries"] += db.query_count
+                stats["rows"] += db.rows_fetched
+                stats["commits"] += db.commit_count
+
+    def snapshot(self):
+        with self._lock:
+            return {endpoint: dict(stats, durations=sorted(stats["durations"]), db_durations=sorted(stats["db_durations"]))
+                    for endpoint, stats in self._endpoints.items()}
+
+
+endpoint_metrics = EndpointMetrics(METRICS_SAMPLE_SIZE)
+
+
+@app.before_request
+def start_request_timer():
+    if SQL_PROFILING:
+        g.request_started = time.perf_counter()
+
+
+# teardown_request runs before the app context teardown, so the request's DBSession is still in g here
+@app.teardown_request
+def record_request_metrics(exception):
+    if 'request_started' in g:
+        endpoint_metrics.record(request.endpoint or "unmatched", time.perf_counter() - g.request_started, g.get('db_session'))
+
+
+@app.after_request
+def add_query_count_header(response):
+    if app.debug and 'db_session' in g:
+        response.headers['X-Query-Count'] = str(g.db_session.query_count)
+    return response
+
+
+# registered after PooledMySQL's teardown, so Flask runs it first and the cursors close before the connection goes back
+@app.teardown_appcontext
+def close_db_session(exception):
+    db = g.pop('db_session', None)
+    if db is None:
+        return
+    leaked = db.close()
+    if leaked:
+        app.logger.warning("%s left %d cursor(s) open", db.endpoint, leaked)
+    if db.query_count > QUERY_COUNT_WARNING:
+        app.logger.warning("%s ran %d queries in one request", db.endpoint, db.query_count)
+
+
+# Password hashing runs in a small process pool so a burst of logins can't hold every request thread on sha256_crypt.
+# This relies on threaded workers (the Procfile runs gthread with WEB_THREADS threads per worker): a thread waiting
+# on the pool releases the GIL, and the other threads keep serving. At most API_HASH_QUEUE logins per worker can be
+# hashing or waiting, so it should stay well under WEB_THREADS -- past it a login gets a 429 instead of a thread.
+# Every gunicorn worker has its own pool, so a dyno runs WEB_CONCURRENCY x API_HASH_WORKERS hashing processes in all.
+# API_HASH_WORKERS=0 hashes inline. Stored hashes with a different round count are rehashed on the next successful login.
+PASSWORD_HASH_ROUNDS = int(os.environ.get('API_HASH_ROUNDS', sha256_crypt.default_rounds))
+PASSWORD_HASH_WORKERS = int(os.environ.get('API_HASH_WORKERS', 2))
+PASSWORD_HASH_QUEUE = int(os.environ.get('API_HASH_QUEUE', 4))
+
+
+class HashingBusy(Exception):
+    pass
+
+
+def hash_password_worker(password, rounds):
+    return sha256_crypt.using(rounds=rounds).hash(password)
+
+
+def verify_password_worker(password, hashed, rounds):
+    # returns (matches, new hash if the stored one needs upgrading else None)
+    if not sha256_crypt.verify(password, hashed):
+        return False, None
+    if sha256_crypt.from_string(hashed).rounds != rounds:
+        return True, hash_password_worker(password, rounds)
+    return True, None
+
+
+class PasswordHasher:
+    # At most queue_size hashes can be running or waiting, past that callers get HashingBusy (a 429) straight away
+    def __init__(self, workers, queue_size, rounds):
+        self.workers = workers
+        self.rounds = rounds
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def hash(self, password):
+        return self._run(hash_password_worker, password, self.rounds)
+
+    def verify(self, password, hashed):
+        return self._run(verify_password_worker, password, hashed, self.rounds)
+
+    def _run(self, fn, *args):
+        if self.workers == 0:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            return self._get_executor().submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def _get_executor(self):
+        # started on first use so the worker processes are forked from the gunicorn worker, not the master
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE, PASSWORD_HASH_ROUNDS)
+
+
+@app.errorhandler(HashingBusy)
+def hashing_busy(error):
+    return {"errorText": "Too many login attempts right now, please try again."}, 429, {"Retry-After": "1"}
 
 PRODUCT_ORDER_DEFAULT = " shop_product_category_id, shop_product_name"
 
+# Storefront catalog cache -- TTL in seconds, max size is the largest number of active products we'll hold in memory
+CATALOG_CACHE_TTL = int(os.environ.get('API_CATALOG_CACHE_TTL', 300))
+CATALOG_CACHE_MAX_SIZE = int(os.environ.get('API_CATALOG_CACHE_MAX_SIZE', 20000))
+CATALOG_GZIP = os.environ.get('API_CATALOG_GZIP') == '1'
+
+
+# the catalog is loaded with these two queries, here as well as in async_app
+CATALOG_CATEGORIES_QUERY = "SELECT * FROM shop_categories ORDER BY shop_category_id"
+CATALOG_PRODUCTS_QUERY = "SELECT * FROM shop_products WHERE shop_product_display = 1 ORDER BY shop_product_price, id LIMIT %s"
+
+
+def build_catalog(categories, products):
+    # groups the active products (already sorted by price) under every category route
+    catalog = {
+        "categories": [c for c in categories if c["shop_category_display"] == 1],
+        "products": products,
+        "keys": [(p["shop_product_price"], p["id"]) for p in products],
+        "by_id": {p["id"]: p for p in products},
+        "by_route": {},
+        "payloads": {}
+    }
+    products_by_category = {}
+    for product in products:
+        products_by_category.setdefault(product["shop_product_category_id"], []).append(product)
+    for category in categories:
+        # first category wins on a duplicate route, same as the old fetchone() lookup
+        if category["shop_category_route"] not in catalog["by_route"]:
+            catalog["by_route"][category["shop_category_route"]] = products_by_category.get(category["shop_category_id"], [])
+    return catalog
+
+
+class CatalogCache:
+    # Holds the active storefront catalog in memory so the /store/get-* endpoints skip MySQL on most page loads.
+    # Every gunicorn worker has its own copy: admin writes invalidate the local one, the TTL bounds how stale the others get.
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.version = 0
+        self._lock = threading.Lock()
+        self._catalog = None
+        self._loaded_at = 0
+        self._invalidated_at = None
+
+    def invalidate(self):
+        with self._lock:
+            self._catalog = None
+            self.version += 1
+            self._invalidated_at = time.monotonic()
+
+    def replica_ok(self):
+        # right after an admin write the replica may not have it yet, and a stale load would be served for the whole TTL
+        return self._invalidated_at is None or time.monotonic() - self._invalidated_at >= REPLICA_CACHE_HOLD_SECONDS
+
+    def peek(self):
+        # the cached catalog if it is still fresh, otherwise None
+        with self._lock:
+            if self._catalog is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return self._catalog
+            return None
+
+    def store(self, catalog, version):
+        # skip storing if an admin write invalidated the cache while we were loading
+        # a catalog bigger than max_size is remembered as oversized (without its rows) so we don't reload it on every request
+        with self._lock:
+            if version != self.version:
+                return
+            if len(catalog["products"]) > self.max_size:
+                catalog = {"oversized": True}
+            catalog["version"] = version
+            self._catalog = catalog
+            self._loaded_at = time.monotonic()
+
+    def get(self):
+        # returns None when the catalog is larger than max_size, callers then fall back to querying MySQL directly
+        catalog = self.peek()
+        if catalog is None:
+            version = self.version
+            catalog = self._load()
+            self.store(catalog, version)
+        if catalog.get("oversized") or len(catalog["products"]) > self.max_size:
+            return None
+        return catalog
+
+    def _load(self):
+        categories = category_table.all()
+        with db_cursor(replica=self.replica_ok()) as cur:
+            cur.execute(CATALOG_PRODUCTS_QUERY, [self.max_size + 1])
+            products = cur.fetchall()
+        return build_catalog(categories, list(products))
+
+
+catalog_cache = CatalogCache(CATALOG_CACHE_TTL, CATALOG_CACHE_MAX_SIZE)
+
+
+class CategoryTable:
+    # shop_categories in memory, by id and by route -- shared by the admin views, the product forms, the catalog and the storefront.
+    # Category writes invalidate it in this worker, the TTL bounds how stale the other workers get (same as the catalog).
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.version = 0
+        self._lock = threading.Lock()
+        self._table = None
+        self._loaded_at = 0
+        self._invalidated_at = None
+
+    def invalidate(self):
+        with self._lock:
+            self._table = None
+            self.version += 1
+            self._invalidated_at = time.monotonic()
+
+    def _get(self):
+        with self._lock:
+            table = self._table
+            if table is not None and time.monotonic() - self._loaded_at >= self.ttl:
+                table = None
+            version = self.version
+            replica = self._invalidated_at is None or time.monotonic() - self._invalidated_at >= REPLICA_CACHE_HOLD_SECONDS
+        if table is None:
+            with db_cursor(replica=replica) as cur:
+                cur.execute(CATALOG_CATEGORIES_QUERY)
+                categories = list(cur.fetchall())
+            table = {"rows": categories, "by_id": {}, "by_route": {}}
+            for category in categories:
+                table["by_id"][category["shop_category_id"]] = category
+                # first category wins on a duplicate route, same as the old fetchone() lookup
+                table["by_route"].setdefault(category["shop_category_route"], category)
+            with self._lock:
+                if version == self.version:
+                    self._table = table
+                    self._loaded_at = time.monotonic()
+        return table
+
+    def all(self):
+        # every category, in id order -- treat the rows as read-only, they're shared
+        return self._get()["rows"]
+
+    def active(self):
+        return [category for category in self.all() if category["shop_category_display"] == 1]
+
+    def get(self, category_id):
+        return self._get()["by_id"].get(category_id)
+
+    def by_route(self, route):
+        # returns None for an unknown route
+        return self._get()["by_route"].get(route)
+
+    def options(self):
+        # (id, name) choices for the product forms, with a placeholder before any category exists
+        return [(category["shop_category_id"], category["shop_category_name"]) for category in self.all()] or [(-1, "None")]
+
+
+category_table = CategoryTable(CATALOG_CACHE_TTL)
+
+
+def build_json_payload(data):
+    # serializes a response body once, with a strong ETag (and a gzipped copy if enabled)
+    body = dumps_json(data)
+    payload = {"body": body, "etag": hashlib.sha1(body).hexdigest()}
+    if CATALOG_GZIP:
+        payload["gzip"] = gzip.compress(body)
+    return payload
+
+
+def catalog_payload(catalog, key, data):
+    # serializes data the first time it's asked for in this catalog version
+    payload = catalog["payloads"].get(key)
+    if payload is None:
+        payload = build_json_payload(data)
+        catalog["payloads"][key] = payload
+    return payload
+
+
+def catalog_response(catalog, key, data):
+    # serves a cached catalog payload -- If-None-Match is answered with a 304 without touching MySQL or the JSON encoder
+    payload = catalog_payload(catalog, key, data)
+    response = app.response_class(mimetype=app.config['JSONIFY_MIMETYPE'])
+    if "gzip" in payload and "gzip" in request.accept_encodings:
+        response.set_data(payload["gzip"])
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(payload["etag"] + "-gz")
+    else:
+        response.set_data(payload["body"])
+        response.set_etag(payload["etag"])
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+# Keyset pagination -- list endpoints take ?limit= and ?after=<cursor>, the next page's cursor comes back in X-Next-Cursor
+# (and ?format=ndjson, see streamed_response)
+PAGE_SIZE_MAX = 500
+ADMIN_PAGE_SIZE = int(os.environ.get('API_ADMIN_PAGE_SIZE', 100))
+
+# columns that can be picked with ?fields= -- the keyset columns are always included
+PRODUCT_FIELDS = ("id", "shop_product_name", "shop_product_brand", "shop_product_price", "shop_product_image_url",
+                  "shop_product_description", "shop_product_category_id", "shop_product_display", "shop_product_onhand")
+TRANSACTION_FIELDS = ("transaction_id", "transaction_user_id", "transaction_cost", "transaction_date", "transaction_address",
+                      "transaction_city", "transaction_state", "transaction_zipcode")
+
+
+class InvalidArgument(Exception):
+    pass
+
+
+@app.errorhandler(InvalidArgument)
+def invalid_argument(error):
+    return {"errorText": str(error)}, 400
+
+
+def encode_cursor(values):
+    def default(obj):
+        if isinstance(obj, decimal.Decimal):
+            return str(obj)
+        if isinstance(obj, datetime.datetime):
+            return obj.isoformat()
+        raise TypeError(type(obj))
+    return base64.urlsafe_b64encode(json.dumps(values, default=default).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor, types):
+    # types converts each cursor value back, e.g. (decimal.Decimal, int)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError(cursor)
+        values = [convert(value) for convert, value in zip(types, values)]
+    except (ValueError, TypeError, ArithmeticError):
+        raise InvalidArgument("Invalid cursor.")
+    if any(isinstance(value, decimal.Decimal) and not value.is_finite() for value in values):
+        raise InvalidArgument("Invalid cursor.") # NaN and Infinity can't be compared with the keyset column
+    return values
+
+
+def page_args(cursor_types, default_limit=None, args=None):
+    # returns (limit, after) -- limit is None for an unpaged request, after is None for the first page
+    # args defaults to request.args, async_app passes its own query mapping
+    args = request.args if args is None else args
+    limit = args.get('limit', default_limit)
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise InvalidArgument("limit must be a number.")
+        if limit < 1 or limit > PAGE_SIZE_MAX:
+            raise InvalidArgument(f"limit must be between 1 and {PAGE_SIZE_MAX}.")
+    after = args.get('after')
+    if after:
+        after = decode_cursor(after, cursor_types)
+    return limit, after
+
+
+def fields_arg(allowed, required, args=None):
+    # ?fields=a,b projection, None when not given
+    fields = (request.args if args is None else args).get('fields')
+    if not fields:
+        return None
+    selected = [field for field in fields.split(",") if field]
+    unknown = [field for field in selected if field not in allowed]
+    if unknown:
+        raise InvalidArgument("Unknown fields: " + ", ".join(unknown))
+    return list(required) + [field for field in selected if field not in required]
+
+
+def project(rows, fields):
+    if fields is None:
+        return list(rows)
+    return [{field: row[field] for field in fields} for row in rows]
+
+
+def paged_body(rows, limit, cursor_of, fmt):
+    # -> (body, mimetype, next page cursor or None)
+    # rows holds up to limit + 1 rows, the extra one only tells us there is a next page
+    rows = list(rows)
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(cursor_of(rows[-1]))
+    if fmt == "ndjson":
+        return encode_chunk(rows, True, True), NDJSON_MIMETYPE, next_cursor
+    return dumps_json(rows), app.config['JSONIFY_MIMETYPE'], next_cursor
+
+
+def paged_response(rows, limit, cursor_of):
+    body, mimetype, next_cursor = paged_body(rows, limit, cursor_of, response_format())
+    response = app.response_class(body, mimetype=mimetype)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+
+# Unpaged list requests are streamed off a server-side cursor STREAM_CHUNK_ROWS rows at a time, so a worker never holds the whole result.
+# ?format=ndjson gives one JSON object per line instead of a single array.
+STREAM_CHUNK_ROWS = int(os.environ.get('API_STREAM_CHUNK_ROWS', 500))
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def response_format(args=None):
+    fmt = (request.args if args is None else args).get('format', 'json')
+    if fmt not in ("json", "ndjson"):
+        raise InvalidArgument("format must be json or ndjson.")
+    return fmt
+
+
+def encode_chunk(rows, ndjson, first):
+    if ndjson:
+        return b"".join(dumps_json(row) for row in rows)
+    # a chunk is encoded as one array and its brackets stripped, so the joined chunks match jsonify byte for byte
+    chunk = dumps_json(list(rows)).rstrip()[1:-1]
+    return chunk if first else b"," + chunk
+
+
+def streamed_response(query, params, transform=None):
+    # the DB connection stays checked out until the last chunk is sent -- stream_with_context holds the request (and app) context open
+    ndjson = response_format() == "ndjson"
+
+    def generate():
+        with db_cursor(server_side=True, replica=True) as cur:
+            cur.execute(query, params)
+            first = True
+            if not ndjson:
+                yield b"["
+            while True:
+                rows = cur.fetchmany(STREAM_CHUNK_ROWS)
+                if not rows:
+                    break
+                if transform is not None:
+                    rows = transform(rows)
+                yield encode_chunk(rows, ndjson, first)
+                first = False
+        if not ndjson:
+            yield b"]\n"
+
+    return app.response_class(stream_with_context(generate()),
+                              mimetype=NDJSON_MIMETYPE if ndjson else app.config['JSONIFY_MIMETYPE'])
+
 
 def is_admin_logged_in(f):
     @wraps(f)
@@ -47,13 +1083,224 @@ def is_admin_logged_in(f):
     return wrap
 
 
+# The home feed pages admin_updatelog newest first on (admin_updatelog_timestamp, admin_updatelog_id) --
+# idx_admin_updatelog_timestamp (migrations/005) makes each page an index range scan however long the log gets.
+UPDATELOG_CURSOR_TYPES = (datetime.datetime.fromisoformat, int)
+UPDATELOG_RETENTION_DAYS = int(os.environ.get('API_UPDATELOG_RETENTION_DAYS', 90))
+UPDATELOG_ARCHIVE_BATCH = int(os.environ.get('API_UPDATELOG_ARCHIVE_BATCH', 1000))
+
+
 @app.route('/')
 def home():
-    cur = mysql.connection.cursor()
-    result = cur.execute("SELECT * FROM admin_updatelog ORDER BY admin_updatelog_timestamp DESC")
-    updates = cur.fetchall()
-    return render_template('home.html', updates=updates)
-    cur.close()
+    limit, after = page_args(UPDATELOG_CURSOR_TYPES, default_limit=ADMIN_PAGE_SIZE)
+    query = "SELECT * FROM admin_updatelog"
+    params = []
+    if after:
+        query += """ WHERE admin_updatelog_timestamp < %s
+                    OR (admin_updatelog_timestamp = %s AND admin_updatelog_id < %s)"""
+        params = [after[0], after[0], after[1]]
+    query += " ORDER BY admin_updatelog_timestamp DESC, admin_updatelog_id DESC LIMIT %s"
+    params.append(limit + 1)
+    with db_cursor() as cur:
+        result = cur.execute(query, params)
+        updates = list(cur.fetchall())
+    next_cursor = None
+    if len(updates) > limit:
+        updates = updates[:limit]
+        last = updates[-1]
+        next_cursor = encode_cursor([last["admin_updatelog_timestamp"], last["admin_updatelog_id"]])
+    return render_template('home.html', updates=updates, next_cursor=next_cursor)
+
+
+# Archival -- run from a scheduler (e.g. daily) to keep admin_updatelog to the last UPDATELOG_RETENTION_DAYS:
+#   FLASK_APP=app flask archive-updatelog [--days N] [--summary-only]
+# Older rows are counted into admin_updatelog_daily (one row per day and admin) and moved to admin_updatelog_archive,
+# or with --summary-only just counted and deleted. Each batch is its own transaction, so the job can be stopped and rerun.
+UPDATELOG_ARCHIVE_COLUMNS = "admin_updatelog_id, admin_updatelog_log, admin_updatelog_admin_id, admin_updatelog_admin, admin_updatelog_timestamp"
+
+
+def archive_updatelog_batch(cutoff, batch_size, summary_only=False):
+    # -> number of rows taken out of admin_updatelog
+    with db_cursor() as cur:
+        cur.execute("""SELECT admin_updatelog_id FROM admin_updatelog WHERE admin_updatelog_timestamp < %s
+                       ORDER BY admin_updatelog_timestamp, admin_updatelog_id LIMIT %s FOR UPDATE""", [cutoff, batch_size])
+        ids = [row["admin_updatelog_id"] for row in cur.fetchall()]
+        if not ids:
+            return 0
+        placeholders = ", ".join(["%s"] * len(ids))
+        cur.execute("""INSERT INTO admin_updatelog_daily
+                       (updatelog_day, updatelog_admin_id, updatelog_admin, updatelog_entries, updatelog_first, updatelog_last)
+                       SELECT DATE(admin_updatelog_timestamp), COALESCE(admin_updatelog_admin_id, 0), MAX(admin_updatelog_admin),
+                              COUNT(*), MIN(admin_updatelog_timestamp), MAX(admin_updatelog_timestamp)
+                       FROM admin_updatelog WHERE admin_updatelog_id IN (""" + placeholders + """)
+                       GROUP BY DATE(admin_updatelog_timestamp), COALESCE(admin_updatelog_admin_id, 0)
+                       ON DUPLICATE KEY UPDATE updatelog_entries = updatelog_entries + VALUES(updatelog_entries),
+                                               updatelog_first = LEAST(updatelog_first, VALUES(updatelog_first)),
+                                               updatelog_last = GREATEST(updatelog_last, VALUES(updatelog_last))""", ids)
+        if not summary_only:
+            cur.execute("INSERT IGNORE INTO admin_updatelog_archive (" + UPDATELOG_ARCHIVE_COLUMNS + ") SELECT "
+                        + UPDATELOG_ARCHIVE_COLUMNS + " FROM admin_updatelog WHERE admin_updatelog_id IN (" + placeholders + ")", ids)
+        cur.execute("DELETE FROM admin_updatelog WHERE admin_updatelog_id IN (" + placeholders + ")", ids)
+        db_session().commit()
+    return len(ids)
+
+
+@app.cli.command("archive-updatelog")
+@click.option("--days", default=UPDATELOG_RETENTION_DAYS, show_default=True, help="Keep this many days in admin_updatelog.")
+@click.option("--batch-size", default=UPDATELOG_ARCHIVE_BATCH, show_default=True)
+@click.option("--summary-only", is_flag=True, help="Keep only the daily summaries, not the archived rows.")
+def archive_updatelog(days, batch_size, summary_only):
+    # the cutoff comes from MySQL's clock, in the same zone as the CURRENT_TIMESTAMP the rows were stamped with
+    with db_cursor() as cur:
+        cur.execute("SELECT NOW() - INTERVAL %s DAY AS cutoff", [days])
+        cutoff = cur.fetchone()["cutoff"]
+    total = 0
+    while True:
+        moved = archive_updatelog_batch(cutoff, batch_size, summary_only)
+        total += moved
+        if moved < batch_size:
+            break
+    click.echo(f"Archived {total} admin_updatelog rows older than {cutoff:%Y-%m-%d %H:%M}.")
+
+
+class BackgroundFlusher:
+    # Calls flush() in an app context every interval seconds on a daemon thread, and once more at exit.
+    # start() is called on first use, so the thread runs in the gunicorn worker, not the master the app was imported in.
+    def __init__(self, name, label, interval, flush, pending=None):
+        self.name = name
+        self.label = label # for the log messages, e.g. "Cart"
+        self.interval = interval
+        self.flush = flush
+        self.pending = pending # optional, -> how many entries a failed exit flush loses
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        atexit.register(self.close)
+
+    def start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                    self._thread.start()
+
+    def _loop(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                with app.app_context():
+                    self.flush()
+            except Exception:
+                app.logger.exception("%s flush failed", self.label)
+
+    def close(self):
+        # at exit -- stop the thread and write what's left
+        self._stopping.set()
+        try:
+            with app.app_context():
+                self.flush()
+        except Exception:
+            if self.pending is None:
+                app.logger.exception("%s flush at exit failed", self.label)
+            else:
+                app.logger.exception("%s flush at exit failed, %d entries lost", self.label, self.pending())
+
+
+# Audit log -- admin changes are logged with audit_log.write(), before the change's commit.
+# In "async" mode (the default) the row is queued once that commit goes through and a background thread inserts
+# the queue in batches every AUDIT_LOG_FLUSH_INTERVAL seconds, so the request doesn't wait on the log insert.
+# A full queue falls back to inserting synchronously. "sync" mode inserts the row in the change's own transaction.
+# The home feed can be up to a flush interval behind in async mode.
+AUDIT_LOG_MODE = os.environ.get('API_AUDIT_LOG_MODE', 'async')
+AUDIT_LOG_FLUSH_INTERVAL = float(os.environ.get('API_AUDIT_LOG_FLUSH_INTERVAL', 1))
+AUDIT_LOG_QUEUE_SIZE = int(os.environ.get('API_AUDIT_LOG_QUEUE_SIZE', 10000))
+AUDIT_LOG_BATCH_SIZE = 500
+
+# sync mode lets MySQL stamp the row, like the inserts before it. Queued entries carry the UTC time they were written
+# and are converted to the session time zone on insert, so they line up with CURRENT_TIMESTAMP whatever the app host's zone.
+AUDIT_LOG_INSERT = """INSERT INTO admin_updatelog(
+                        admin_updatelog_log,
+                        admin_updatelog_admin_id,
+                        admin_updatelog_admin
+                        ) VALUES(%s, %s, %s)"""
+AUDIT_LOG_INSERT_QUEUED = """INSERT INTO admin_updatelog(
+                               admin_updatelog_log,
+                               admin_updatelog_admin_id,
+                               admin_updatelog_admin,
+                               admin_updatelog_timestamp
+                               ) VALUES """
+AUDIT_LOG_QUEUED_ROW = "(%s, %s, %s, CONVERT_TZ(%s, '+00:00', @@session.time_zone))"
+
+
+def insert_queued_audit_rows(cur, rows):
+    # one multi-row INSERT -- executemany only batches plain %s values, not the CONVERT_TZ
+    cur.execute(AUDIT_LOG_INSERT_QUEUED + ", ".join([AUDIT_LOG_QUEUED_ROW] * len(rows)), [value for row in rows for value in row])
+
+
+class AuditLogWriter:
+    def __init__(self, mode, flush_interval, queue_size, batch_size):
+        self.mode = mode
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._queue = queue.Queue(queue_size)
+        self._retry = [] # a batch whose insert failed, tried again before anything new
+        self._flush_lock = threading.Lock()
+        self._flusher = BackgroundFlusher("audit-log-flusher", "Audit log", flush_interval, self.flush, self.pending)
+        self.stats = {"queued": 0, "written": 0, "overflows": 0, "flush_errors": 0}
+
+    def write(self, message, admin_id, admin):
+        if self.mode == "sync":
+            with db_cursor() as cur:
+                cur.execute(AUDIT_LOG_INSERT, (message, admin_id, admin))
+        else:
+            # the timestamp is taken now, so a queued entry sorts where it happened in the home feed
+            row = (message, admin_id, admin, datetime.datetime.utcnow())
+            db_session().after_commit.append(lambda: self._enqueue(row))
+
+    def _enqueue(self, row):
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.stats["overflows"] += 1
+            with db_cursor() as cur:
+                insert_queued_audit_rows(cur, [row])
+            db_session().commit()
+            return
+        self.stats["queued"] += 1
+        self._flusher.start()
+
+    def _take_batch(self):
+        batch, self._retry = self._retry, []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self):
+        # -> number of rows written
+        written = 0
+        with self._flush_lock:
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    return written
+                try:
+                    with db_cursor() as cur:
+                        insert_queued_audit_rows(cur, batch)
+                    db_session().commit()
+                except Exception:
+                    self._retry = batch
+                    self.stats["flush_errors"] += 1
+                    raise
+                written += len(batch)
+                self.stats["written"] += len(batch)
+
+    def pending(self):
+        return len(self._retry) + self._queue.qsize()
+
+
+audit_log = AuditLogWriter(AUDIT_LOG_MODE, AUDIT_LOG_FLUSH_INTERVAL, AUDIT_LOG_QUEUE_SIZE, AUDIT_LOG_BATCH_SIZE)
 
 
 class AdminRegisterForm(Form):
@@ -69,47 +1316,42 @@ class AdminRegisterForm(Form):
     confirm = PasswordField('Confirm Password')
 
 
+def admin_username_taken(username):
+    with db_cursor() as cur:
+        result = cur.execute("SELECT 1 FROM admin_user WHERE admin_user_username = %s LIMIT 1", [username])
+    return result > 0
+
+
 @app.route('/register', methods=['GET', 'POST'])
 def admin_register():
     form = AdminRegisterForm(request.form)
-    cur = mysql.connection.cursor()
-    result = cur.execute("SELECT * FROM admin_user")
-    current_users = cur.fetchall()
-    current_user_list = []
-
-    for user in current_users:
-        current_user_list.append(user["admin_user_username"])
-
-    if request.method == 'POST' and form.username.data in current_user_list:
+    if request.method == 'POST' and admin_username_taken(form.username.data):
         flash('That username has already been taken.', 'danger')
     elif request.method == 'POST' and form.validate():
         firstname = form.firstname.data
         lastname = form.lastname.data
         username = form.username.data
         employee_id = form.employee_id.data
-        password = sha256_crypt.hash(str(form.password.data))
-        cur = mysql.connection.cursor() 
-        cur.execute("""INSERT INTO admin_user(
-                            admin_user_firstname,
-                            admin_user_lastname, 
-                            admin_user_employee_id, 
-                            admin_user_username, 
-                            admin_user_password
-                            ) VALUES(%s, %s, %s, %s, %s)""",
-                            (firstname, lastname, employee_id, username, password))
-        mysql.connection.commit()
-        result = cur.execute("SELECT * FROM admin_user WHERE admin_user_username = %s", [username])
-        data = cur.fetchone()
-        admin_id = data['admin_user_id']
-        log_message = f"Registered {username} (Employee #{employee_id}) in PetStash Back Office."
-        cur.execute("""INSERT INTO admin_updatelog(
-                        admin_updatelog_log,
-                        admin_updatelog_admin_id, 
-                        admin_updatelog_admin
-                        ) VALUES(%s, %s, %s)""",
-                        (log_message, admin_id, username))
-        mysql.connection.commit()
-        cur.close()
+        password = password_hasher.hash(str(form.password.data))
+        with db_cursor() as cur:
+            try:
+                cur.execute("""INSERT INTO admin_user(
+                                    admin_user_firstname,
+                                    admin_user_lastname, 
+                                    admin_user_employee_id, 
+                                    admin_user_username, 
+                                    admin_user_password
+                                    ) VALUES(%s, %s, %s, %s, %s)""",
+                                    (firstname, lastname, employee_id, username, password))
+            except MySQLdb.IntegrityError:
+                # lost a race with another registration for the same username
+                db_session().rollback()
+                flash('That username has already been taken.', 'danger')
+                return render_template('register.html', form=form)
+            admin_id = cur.lastrowid
+            log_message = f"Registered {username} (Employee #{employee_id}) in PetStash Back Office."
+        audit_log.write(log_message, admin_id, username)
+        db_session().commit()
         flash('You are now registered and can log in', 'success')
         return redirect(url_for('home'))
     return render_template('register.html', form=form)
@@ -120,19 +1362,26 @@ def admin_login():
     if request.method == "POST":
         username = request.form['username']
         password_input = request.form['password']
-        cur = mysql.connection.cursor()
-        result = cur.execute("SELECT * FROM admin_user WHERE admin_user_username = %s", [username])
-        if result > 0:
+        with db_cursor() as cur:
+            result = cur.execute("SELECT * FROM admin_user WHERE admin_user_username = %s", [username])
             user = cur.fetchone()
+        if result > 0:
             password = user["admin_user_password"]
-            if sha256_crypt.verify(password_input, password):
+            password_match, new_hash = password_hasher.verify(password_input, password)
+            if password_match:
+                if new_hash:
+                    with db_cursor() as cur:
+                        cur.execute("UPDATE admin_user SET admin_user_password = %s WHERE admin_user_id = %s", (new_hash, user["admin_user_id"]))
+                    db_session().commit()
                 session['admin_logged_in'] = True
                 session['admin_username'] = username
                 session['admin_lastname'] = user["admin_user_lastname"]
                 session['admin_id'] = user["admin_user_id"]
                 flash("You are now logged in.","success")
                 return redirect(url_for('home'))
-        
+            else:
+                flash('Invalid password.', 'danger')
+                return render_template('login.html')
         else:
             flash('Username not found.', 'danger')
             return render_template('login.html')
@@ -142,10 +1391,7 @@ def admin_login():
 
 @app.route('/categories')
 def categories():
-    cur = mysql.connection.cursor()
-    result = cur.execute("SELECT * FROM shop_categories")
-    categories = cur.fetchall()
-    return render_template('categories.html', categories=categories)
+    return render_template('categories.html', categories=category_table.all())
 
 
 class CategoryForm(Form):
@@ -173,28 +1419,23 @@ def category_add():
         banner_display = form.banner_display.data
         banner_button = form.banner_button.data
         banner_caption = form.banner_caption.data
-        cur = mysql.connection.cursor()
-        cur.execute("""INSERT INTO shop_categories(
-                        shop_category_name, 
-                        shop_category_display, 
-                        shop_category_route, 
-                        shop_category_icon_url, 
-                        shop_category_banner_url, 
-                        shop_category_banner_display, 
-                        shop_category_banner_button, 
-                        shop_category_banner_caption
-                        ) VALUES(%s, %s, %s, %s, %s, %s, %s, %s)""",
-                        (name, display, route, icon_url, banner_url, banner_display, banner_button, banner_caption))
-        mysql.connection.commit()
         log_message = f"Created new product category: {name}."
-        cur.execute("""INSERT INTO admin_updatelog(
-                        admin_updatelog_log, 
-                        admin_updatelog_admin_id, 
-                        admin_updatelog_admin
-                        ) VALUES(%s, %s, %s)""", 
-                        (log_message, session['admin_id'], session['admin_username']))
-        mysql.connection.commit()
-        cur.close()
+        with db_cursor() as cur:
+            cur.execute("""INSERT INTO shop_categories(
+                            shop_category_name, 
+                            shop_category_display, 
+                            shop_category_route, 
+                            shop_category_icon_url, 
+                            shop_category_banner_url, 
+                            shop_category_banner_display, 
+                            shop_category_banner_button, 
+                            shop_category_banner_caption
+                            ) VALUES(%s, %s, %s, %s, %s, %s, %s, %s)""",
+                            (name, display, route, icon_url, banner_url, banner_display, banner_button, banner_caption))
+        audit_log.write(log_message, session['admin_id'], session['admin_username'])
+        db_session().commit()
+        catalog_cache.invalidate()
+        category_table.invalidate()
         flash("Category Successfully Added", 'success')
         return redirect(url_for("categories"))
     return render_template('category_add.html', form=form)
@@ -203,9 +1444,9 @@ def category_add():
 @app.route('/category-edit/<string:id>', methods=["GET","POST"])
 @is_admin_logged_in
 def category_edit(id):
-    cur = mysql.connection.cursor()
-    result = cur.execute("SELECT * FROM shop_categories WHERE shop_category_id = %s", [id])
-    category = cur.fetchone()
+    with db_cursor() as cur:
+        result = cur.execute("SELECT * FROM shop_categories WHERE shop_category_id = %s", [id])
+        category = cur.fetchone()
     form = CategoryForm(request.form)
     form.name.data = category["shop_category_name"]
     form.display.data = str(category["shop_category_display"])
@@ -224,27 +1465,23 @@ def category_edit(id):
         banner_display = request.form['banner_display']
         banner_button = request.form['banner_button']
         banner_caption = request.form['banner_caption']
-        cur.execute("""UPDATE shop_categories
-                        SET shop_category_name = %s,
-                        shop_category_display = %s,
-                        shop_category_route = %s,
-                        shop_category_icon_url = %s,
-                        shop_category_banner_url = %s,
-                        shop_category_banner_display = %s,
-                        shop_category_banner_button = %s,
-                        shop_category_banner_caption = %s
-                        WHERE shop_category_id = %s""",
-                        (name, display, route, icon_url, banner_url, banner_display, banner_button, banner_caption, id))
-        mysql.connection.commit()
         log_message = f"Updated product category: {name}."
-        cur.execute("""INSERT INTO admin_updatelog(
-                        admin_updatelog_log,
-                        admin_updatelog_admin_id, 
-                        admin_updatelog_admin
-                        ) VALUES(%s, %s, %s)""",
-                        (log_message, session['admin_id'], session['admin_username']))
-        mysql.connection.commit()
-        cur.close()
+        with db_cursor() as cur:
+            cur.execute("""UPDATE shop_categories
+                            SET shop_category_name = %s,
+                            shop_category_display = %s,
+                            shop_category_route = %s,
+                            shop_category_icon_url = %s,
+                            shop_category_banner_url = %s,
+                            shop_category_banner_display = %s,
+                            shop_category_banner_button = %s,
+                            shop_category_banner_caption = %s
+                            WHERE shop_category_id = %s""",
+                            (name, display, route, icon_url, banner_url, banner_display, banner_button, banner_caption, id))
+        audit_log.write(log_message, session['admin_id'], session['admin_username'])
+        db_session().commit()
+        catalog_cache.invalidate()
+        category_table.invalidate()
         flash("Category Successfully Added", 'success')
         return redirect(url_for("categories"))
     return render_template("category_edit.html", form=form)
@@ -252,22 +1489,55 @@ def category_edit(id):
 #TODO: BUILD CATEGORY DELETE --- How to handle product reassignment?
 
 
+# The admin product and inventory pages walk shop_products by (shop_product_category_id, shop_product_name, id) on
+# idx_shop_products_category_name (migrations/006). MySQL sorts NULL first, so uncategorized products come before the rest;
+# the keyset works on the raw column (a COALESCE would rule out the index) and handles a NULL category in the cursor itself.
+CATEGORY_CURSOR_TYPES = (lambda value: None if value is None else int(value), str, int)
+
+
+def category_keyset(after):
+    # -> (condition, params) for the rows after the cursor [category id or None, name, id]
+    category_id, name, product_id = after
+    if category_id is None:
+        return ("""((shop_product_category_id IS NULL AND (shop_product_name > %s OR (shop_product_name = %s AND id > %s)))
+                    OR shop_product_category_id IS NOT NULL)""", [name, name, product_id])
+    return ("""(shop_product_category_id > %s
+                OR (shop_product_category_id = %s AND (shop_product_name > %s OR (shop_product_name = %s AND id > %s))))""",
+            [category_id, category_id, name, name, product_id])
+
+
+def category_cursor(product):
+    return [product["shop_product_category_id"], product["shop_product_name"], product["id"]]
+
+
 @app.route("/products")
 def products():
-    cur = mysql.connection.cursor()
-    result = cur.execute("""SELECT p.id,
-                            p.shop_product_name, 
-                            p.shop_product_brand, 
-                            p.shop_product_price, 
-                            p.shop_product_display, 
-                            p.shop_product_onhand, 
-                            c.shop_category_name
-                            FROM shop_products p
-                            LEFT JOIN shop_categories c
-                            ON c.shop_category_id = p.shop_product_category_id
-                            ORDER BY """ + PRODUCT_ORDER_DEFAULT)
-    products = cur.fetchall()
-    return render_template('products.html', products=products)
+    limit, after = page_args(CATEGORY_CURSOR_TYPES, default_limit=ADMIN_PAGE_SIZE)
+    query = """SELECT id,
+                shop_product_name, 
+                shop_product_brand, 
+                shop_product_price, 
+                shop_product_display, 
+                shop_product_onhand, 
+                shop_product_category_id
+                FROM shop_products"""
+    params = []
+    if after:
+        condition, params = category_keyset(after)
+        query += " WHERE " + condition
+    query += " ORDER BY shop_product_category_id, shop_product_name, id LIMIT %s"
+    params.append(limit + 1)
+    with db_cursor() as cur:
+        result = cur.execute(query, params)
+        products = list(cur.fetchall())
+    next_cursor = None
+    if len(products) > limit:
+        products = products[:limit]
+        next_cursor = encode_cursor(category_cursor(products[-1]))
+    for product in products:
+        category = category_table.get(product["shop_product_category_id"])
+        product["shop_category_name"] = category["shop_category_name"] if category else None
+    return render_template('products.html', products=products, next_cursor=next_cursor)
 
 
 class ProductForm(Form):
@@ -283,17 +1553,7 @@ class ProductForm(Form):
 
 def product_category_options():
     # populates the dropdown menu for primary category choices
-    cur = mysql.connection.cursor()
-    result = cur.execute("SELECT * FROM shop_categories")
-    categories = cur.fetchall()
-    category_list = []
-    if result == 0:
-        category_list = [(-1,"None")]
-    else:
-        for category in categories:
-            category_list.append((category["shop_category_id"], category["shop_category_name"]))
-    cur.close()
-    return category_list
+    return category_table.options()
 
 def product_category_parse(category_data):
     # for return a Null value if no primary category is set, just to catch errors before categories are created.
@@ -316,27 +1576,23 @@ def product_add():
         description = form.description.data
         category = product_category_parse(form.category.data)
         display = int(form.display.data)
-        cur = mysql.connection.cursor()
-        cur.execute("""INSERT INTO shop_products(
-                        shop_product_name,
-                        shop_product_brand, 
-                        shop_product_price, 
-                        shop_product_image_url, 
-                        shop_product_description, 
-                        shop_product_category_id, 
-                        shop_product_display
-                        ) VALUES(%s, %s, %s, %s, %s, %s, %s)""",
-                        (name, brand, price, image_url, description, category, display))
-        mysql.connection.commit()
         log_message = f"Successfully added new product: {name} by {brand}."
-        cur.execute("""INSERT INTO admin_updatelog(
-                        admin_updatelog_log, 
-                        admin_updatelog_admin_id, 
-                        admin_updatelog_admin
-                        ) VALUES(%s, %s, %s)""",
-                        (log_message, session['admin_id'], session['admin_username']))
-        mysql.connection.commit()
-        cur.close()
+        with db_cursor() as cur:
+            cur.execute("""INSERT INTO shop_products(
+                            shop_product_name,
+                            shop_product_brand, 
+                            shop_product_price, 
+                            shop_product_image_url, 
+                            shop_product_description, 
+                            shop_product_category_id, 
+                            shop_product_display
+                            ) VALUES(%s, %s, %s, %s, %s, %s, %s)""",
+                            (name, brand, price, image_url, description, category, display))
+            product_id = cur.lastrowid
+        audit_log.write(log_message, session['admin_id'], session['admin_username'])
+        db_session().commit()
+        catalog_cache.invalidate()
+        search_index.refresh([product_id])
         flash("Product Successfully Added", 'success')
         return redirect(url_for("products"))
     return render_template('product_add.html', form=form)
@@ -345,9 +1601,9 @@ def product_add():
 @app.route('/product-edit/<string:id>', methods=["GET","POST"])
 @is_admin_logged_in
 def product_edit(id):
-    cur = mysql.connection.cursor()
-    result = cur.execute("SELECT * FROM shop_products WHERE id = %s", [id])
-    product = cur.fetchone()
+    with db_cursor() as cur:
+        result = cur.execute("SELECT * FROM shop_products WHERE id = %s", [id])
+        product = cur.fetchone()
     form = ProductForm(request.form)
     form.category.choices = product_category_options()
     form.name.data = product["shop_product_name"]
@@ -366,28 +1622,22 @@ def product_edit(id):
         description = request.form['description']
         category = product_category_parse(request.form['category'])
         display = int(request.form['display'])
-        cur = mysql.connection.cursor()
-        cur.execute("""UPDATE shop_products
-                    SET shop_product_name = %s,
-                    shop_product_brand = %s,
-                    shop_product_price = %s,
-                    shop_product_image_url = %s,
-                    shop_product_description = %s,
-                    shop_product_category_id = %s,
-                    shop_product_display = %s
-                    WHERE id = %s""",
-                    (name, brand, price, image_url, description, category, display, id))
-        mysql.connection.commit()
-
         log_message = f"Successfully updated product: {name} by {brand}."
-        cur.execute("""INSERT INTO admin_updatelog(
-                        admin_updatelog_log, 
-                        admin_updatelog_admin_id, 
-                        admin_updatelog_admin
-                        ) VALUES(%s, %s, %s)""", 
-                        (log_message, session['admin_id'], session['admin_username']))
-        mysql.connection.commit()
-        cur.close()
+        with db_cursor() as cur:
+            cur.execute("""UPDATE shop_products
+                        SET shop_product_name = %s,
+                        shop_product_brand = %s,
+                        shop_product_price = %s,
+                        shop_product_image_url = %s,
+                        shop_product_description = %s,
+                        shop_product_category_id = %s,
+                        shop_product_display = %s
+                        WHERE id = %s""",
+                        (name, brand, price, image_url, description, category, display, id))
+        audit_log.write(log_message, session['admin_id'], session['admin_username'])
+        db_session().commit()
+        catalog_cache.invalidate()
+        search_index.refresh([id])
         flash("Product Successfully Updated", 'success')
         return redirect(url_for("products"))
     return render_template("product_edit.html", form=form)
@@ -395,47 +1645,330 @@ def product_edit(id):
 #TODO: BUILD DELETE PRODUCT
 
 
-class InventoryEntryForm(Form):
-    product_name = StringField('name')
-    product_id = IntegerField('product_id')
-    onhand = IntegerField('Update Onhand', [validators.NumberRange(min=0)])
-
-class InventoryListForm(Form):
-    inventory_list = FieldList(FormField(InventoryEntryForm))
+# Bulk import/export -- rows use the ProductForm field names, so an export can be edited and imported back.
+#   GET /products/export?format=csv|ndjson|json
+#   POST /products/import?format=csv|ndjson with the file as the request body or a multipart "file" field
+# Imported rows are validated with ProductForm and written PRODUCT_IMPORT_CHUNK_ROWS at a time, one transaction per chunk:
+# rows with an id are upserted, the rest inserted. An empty category means uncategorized (NULL). Invalid rows are
+# skipped and reported; onhand is export-only (stock goes through /inventory).
+PRODUCT_IMPORT_CHUNK_ROWS = int(os.environ.get('API_PRODUCT_IMPORT_CHUNK_ROWS', 1000))
+PRODUCT_IMPORT_MAX_ERRORS = 100
+PRODUCT_EXPORT_COLUMNS = ("id", "name", "brand", "price", "image_url", "description", "category", "display", "onhand")
+PRODUCT_EXPORT_QUERY = """SELECT id, shop_product_name AS name, shop_product_brand AS brand, shop_product_price AS price,
+                          shop_product_image_url AS image_url, shop_product_description AS description,
+                          shop_product_category_id AS category, shop_product_display AS display, shop_product_onhand AS onhand
+                          FROM shop_products ORDER BY id"""
+PRODUCT_IMPORT_COLUMNS = """shop_product_name,
+                            shop_product_brand,
+                            shop_product_price,
+                            shop_product_image_url,
+                            shop_product_description,
+                            shop_product_category_id,
+                            shop_product_display"""
+PRODUCT_IMPORT_INSERT = "INSERT INTO shop_products(" + PRODUCT_IMPORT_COLUMNS + ") VALUES(%s, %s, %s, %s, %s, %s, %s)"
+PRODUCT_IMPORT_UPSERT = """INSERT INTO shop_products(id, """ + PRODUCT_IMPORT_COLUMNS + """) VALUES(%s, %s, %s, %s, %s, %s, %s, %s)
+                           ON DUPLICATE KEY UPDATE
+                           shop_product_name = VALUES(shop_product_name),
+                           shop_product_brand = VALUES(shop_product_brand),
+                           shop_product_price = VALUES(shop_product_price),
+                           shop_product_image_url = VALUES(shop_product_image_url),
+                           shop_product_description = VALUES(shop_product_description),
+                           shop_product_category_id = VALUES(shop_product_category_id),
+                           shop_product_display = VALUES(shop_product_display)"""
+
+
+def import_records(upload, fmt):
+    # yields (line number, row dict or None, error or None) off the upload, one line at a time
+    lines = codecs.iterdecode(upload, "utf-8-sig")
+    if fmt == "csv":
+        reader = csv.DictReader(lines)
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as error:
+                yield reader.line_num, None, str(error)
+                continue
+            yield reader.line_num, row, None
+    else:
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield number, None, "not valid JSON"
+                continue
+            if not isinstance(row, dict):
+                yield number, None, "not a JSON object"
+                continue
+            yield number, row, None
+
+
+def validate_import_row(row, category_choices):
+    # -> (product id or None, insert params) or raises ValueError with ProductForm's messages
+    formdata = MultiDict((key, "" if value is None else str(value)) for key, value in row.items() if key)
+    if not formdata.get("category"):
+        formdata["category"] = "-1"
+    formdata.setdefault("display", "1")
+    form = ProductForm(formdata)
+    form.category.choices = category_choices
+    if not form.validate():
+        raise ValueError("; ".join(f"{field}: {' '.join(messages)}" for field, messages in form.errors.items()))
+    product_id = formdata.get("id")
+    if product_id:
+        try:
+            product_id = int(product_id)
+        except ValueError:
+            raise ValueError("id: Not a valid integer value")
+    params = (form.name.data, form.brand.data, form.price.data, form.image_url.data, form.description.data,
+              product_category_parse(form.category.data), int(form.display.data))
+    return product_id or None, params
+
+
+def write_import_chunk(new_rows, updated_rows):
+    with db_cursor() as cur:
+        if new_rows:
+            cur.executemany(PRODUCT_IMPORT_INSERT, new_rows)
+        if updated_rows:
+            cur.executemany(PRODUCT_IMPORT_UPSERT, updated_rows)
+    db_session().commit()
+
+
+@app.route('/products/import', methods=["POST"])
+@is_admin_logged_in
+def product_import():
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('file')
+        if upload is None:
+            raise InvalidArgument("No file uploaded.")
+        default_format = "ndjson" if (upload.filename or "").endswith((".ndjson", ".jsonl")) else "csv"
+    else:
+        upload = request.stream
+        default_format = "ndjson" if request.mimetype == NDJSON_MIMETYPE else "csv"
+    fmt = request.args.get('format', default_format)
+    if fmt not in ("csv", "ndjson"):
+        raise InvalidArgument("format must be csv or ndjson.")
+    # an empty category is imported as NULL (-1, as in product_category_parse), which is how the export writes uncategorized products
+    category_choices = [choice for choice in product_category_options() if choice[0] != -1] + [(-1, "None")]
+    new_rows, updated_rows = [], []
+    summary = {"inserted": 0, "upserted": 0, "rejected": 0, "errors": []}
+    try:
+        for number, row, error in import_records(upload, fmt):
+            if error is None:
+                try:
+                    product_id, params = validate_import_row(row, category_choices)
+                except ValueError as invalid:
+                    error = str(invalid)
+            if error is not None:
+                summary["rejected"] += 1
+                if len(summary["errors"]) < PRODUCT_IMPORT_MAX_ERRORS:
+                    summary["errors"].append({"line": number, "error": error})
+                continue
+            if product_id is None:
+                new_rows.append(params)
+            else:
+                updated_rows.append((product_id,) + params)
+            if len(new_rows) + len(updated_rows) >= PRODUCT_IMPORT_CHUNK_ROWS:
+                write_import_chunk(new_rows, updated_rows)
+                summary["inserted"] += len(new_rows)
+                summary["upserted"] += len(updated_rows)
+                new_rows, updated_rows = [], []
+        if new_rows or updated_rows:
+            write_import_chunk(new_rows, updated_rows)
+            summary["inserted"] += len(new_rows)
+            summary["upserted"] += len(updated_rows)
+    finally:
+        # chunks already committed stay, even if a later one failed
+        if summary["inserted"] or summary["upserted"]:
+            catalog_cache.invalidate()
+            search_index.invalidate()
+    if summary["inserted"] or summary["upserted"]:
+        audit_log.write(f"Imported products: {summary['inserted']} added, {summary['upserted']} added or updated by id.",
+                        session['admin_id'], session['admin_username'])
+        db_session().commit()
+    return summary
+
+
+def csv_chunk(rows, header=False):
+    out = io.StringIO()
+    writer = csv.DictWriter(out, PRODUCT_EXPORT_COLUMNS, extrasaction='ignore')
+    if header:
+        writer.writeheader()
+    writer.writerows(rows)
+    return out.getvalue().encode("utf-8")
+
+
+@app.route('/products/export')
+@is_admin_logged_in
+def product_export():
+    if request.args.get('format', 'csv') != 'csv':
+        return streamed_response(PRODUCT_EXPORT_QUERY, [])
+
+    def generate():
+        yield csv_chunk([], header=True)
+        with db_cursor(server_side=True, replica=True) as cur:
+            cur.execute(PRODUCT_EXPORT_QUERY)
+            while True:
+                rows = cur.fetchmany(STREAM_CHUNK_ROWS)
+                if not rows:
+                    break
+                yield csv_chunk(rows)
+
+    return app.response_class(stream_with_context(generate()), mimetype='text/csv',
+                              headers={"Content-Disposition": "attachment; filename=products.csv"})
+
+
+BATCH_UPDATE_SIZE = 500
+
+
+def case_by_id(values):
+    # builds "CASE id WHEN .. THEN .. END" over an {id: value} dict, for set-based UPDATEs
+    params = []
+    for key, value in values.items():
+        params += [key, value]
+    return "CASE id" + " WHEN %s THEN %s" * len(values) + " END", params
+
+
+def update_onhand_batch(cur, onhand_by_id):
+    # one UPDATE per BATCH_UPDATE_SIZE products instead of one per product -- caller commits
+    product_ids = list(onhand_by_id)
+    for start in range(0, len(product_ids), BATCH_UPDATE_SIZE):
+        chunk = {product_id: onhand_by_id[product_id] for product_id in product_ids[start:start + BATCH_UPDATE_SIZE]}
+        case_sql, params = case_by_id(chunk)
+        cur.execute("UPDATE shop_products SET shop_product_onhand = " + case_sql +
+                    " WHERE id IN (" + ", ".join(["%s"] * len(chunk)) + ")", params + list(chunk))
+
+
+INVENTORY_FIELD = re.compile(r"^onhand-(\d+)$")
+
+
+def inventory_deltas(form):
+    # -> ({product_id: new onhand}, [product ids with a bad count]) for the onhand-<id> inputs that differ from their was-<id> value
+    # untouched rows are skipped without parsing them
+    changes = {}
+    invalid = []
+    for key, value in form.items():
+        match = INVENTORY_FIELD.match(key)
+        if match is None or value.strip() == form.get("was-" + match.group(1), "").strip():
+            continue
+        product_id = int(match.group(1))
+        try:
+            onhand = int(value)
+        except ValueError:
+            onhand = -1
+        if onhand < 0:
+            invalid.append(product_id)
+        else:
+            changes[product_id] = onhand
+    return changes, invalid
 
 
+# One page of products at a time (see category_keyset), optionally for one category (?category=<id>, 0 for uncategorized), rendered from plain rows
 @app.route('/inventory', methods=["GET","POST"])
 @is_admin_logged_in
 def receive_order():
-    cur = mysql.connection.cursor()
-    result = cur.execute("SELECT shop_product_name, id, shop_product_onhand FROM shop_products ORDER BY " + PRODUCT_ORDER_DEFAULT)
-    products = cur.fetchall()
-    inventory_form = InventoryListForm(request.form)
-    if request.method == "POST" and inventory_form.validate():
-        for update in inventory_form.inventory_list:
-            product_id = update.product_id.data
-            onhand = update.onhand.data
-            print(update.product_name.data,product_id,onhand)
-            cur.execute("""UPDATE shop_products
-                        SET shop_product_onhand = %s
-                        WHERE id = %s""", (onhand, product_id))
-            mysql.connection.commit()
-        flash("Inventory successfully updated","success")
-        return redirect(url_for("home"))
-    elif request.method == "POST":
-        flash("Can only accept numeric edits above 0.","danger")
-        return redirect(url_for("receive_order"))
-    if result > 0:
-        for product in products:
-            product_form = InventoryEntryForm()
-            product_form.product_name = product['shop_product_name']
-            product_form.product_id = product['id']
-            product_form.onhand = product['shop_product_onhand']
-            inventory_form.inventory_list.append_entry(product_form)
-        return render_template("inventory.html", form=inventory_form)
-    else:
+    if request.method == "POST":
+        changes, invalid = inventory_deltas(request.form)
+        if invalid:
+            flash("Can only accept numeric edits above 0.","danger")
+            return redirect(request.full_path)
+        if changes:
+            with db_cursor() as cur:
+                update_onhand_batch(cur, changes)
+            db_session().commit()
+            catalog_cache.invalidate()
+            search_index.refresh(changes)
+        flash(f"Inventory successfully updated ({len(changes)} products changed)","success")
+        return redirect(request.full_path)
+
+    limit, after = page_args(CATEGORY_CURSOR_TYPES, default_limit=ADMIN_PAGE_SIZE)
+    category = request.args.get('category', type=int)
+    query = """SELECT id, shop_product_name, shop_product_onhand, shop_product_category_id
+                FROM shop_products"""
+    conditions = []
+    params = []
+    if category == 0:
+        conditions.append("shop_product_category_id IS NULL")
+    elif category is not None:
+        conditions.append("shop_product_category_id = %s")
+        params.append(category)
+    if after:
+        condition, after_params = category_keyset(after)
+        conditions.append(condition)
+        params += after_params
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY shop_product_category_id, shop_product_name, id LIMIT %s"
+    params.append(limit + 1)
+    with db_cursor() as cur:
+        result = cur.execute(query, params)
+        products = list(cur.fetchall())
+    if not products and not after and category is None:
         flash("No products found", "danger")
         return redirect(url_for("home"))
+    next_cursor = None
+    if len(products) > limit:
+        products = products[:limit]
+        next_cursor = encode_cursor(category_cursor(products[-1]))
+    return render_template("inventory.html", products=products, next_cursor=next_cursor,
+                           categories=product_category_options(), category=category)
+
+
+def quantile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+# Prometheus text format -- per-endpoint request/DB time summaries and SQL counters (with API_SQL_PROFILING=1) plus the connection pool stats
+@app.route('/metrics')
+@is_admin_logged_in
+def metrics():
+    lines = []
+    summaries = [
+        ("petstash_request_duration_seconds", "Request latency by endpoint.", "durations", "duration_seconds"),
+        ("petstash_db_duration_seconds", "Time spent in MySQL per request, by endpoint.", "db_durations", "db_seconds")
+    ]
+    counters = [
+        ("petstash_db_queries_total", "SQL statements run, by endpoint.", "queries"),
+        ("petstash_db_rows_fetched_total", "Rows fetched, by endpoint.", "rows"),
+        ("petstash_db_commits_total", "Commits, by endpoint.", "commits")
+    ]
+    endpoints = endpoint_metrics.snapshot()
+    for name, help_text, samples, total in summaries:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} summary"]
+        for endpoint, stats in sorted(endpoints.items()):
+            for q in (0.5, 0.95, 0.99):
+                lines.append(f'{name}{{endpoint="{endpoint}",quantile="{q}"}} {quantile(stats[samples], q):.6f}')
+            lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {stats[total]:.6f}')
+            lines.append(f'{name}_count{{endpoint="{endpoint}"}} {stats["requests"]}')
+    for name, help_text, key in counters:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        for endpoint, stats in sorted(endpoints.items()):
+            lines.append(f'{name}{{endpoint="{endpoint}"}} {stats[key]}')
+    pools = [("petstash_db_pool_", mysql.get_pool())]
+    if mysql.has_replica:
+        pools.append(("petstash_db_replica_pool_", mysql.get_pool(replica=True)))
+    for prefix, pool in pools:
+        for key, value in sorted(pool.metrics().items()):
+            metric_type = "counter" if key in ("checkouts", "timeouts", "wait_seconds_total", "connections_created",
+                                               "connections_recycled", "health_check_failures") else "gauge"
+            name = prefix + key + ("_total" if metric_type == "counter" and not key.endswith("_total") else "")
+            lines += [f"# TYPE {name} {metric_type}", f"{name} {value}"]
+    if cart_store.write_behind:
+        for key, value in sorted(cart_store.stats.items()):
+            lines += [f"# TYPE petstash_cart_{key}_total counter", f"petstash_cart_{key}_total {value}"]
+    if audit_log.mode != "sync":
+        lines += ["# TYPE petstash_audit_log_queue_size gauge", f"petstash_audit_log_queue_size {audit_log.pending()}"]
+        for key, value in sorted(audit_log.stats.items()):
+            lines += [f"# TYPE petstash_audit_log_{key}_total counter", f"petstash_audit_log_{key}_total {value}"]
+    if mysql.has_replica:
+        replica_stats = mysql.replica_health.metrics()
+        lines += ["# TYPE petstash_db_replica_available gauge", f"petstash_db_replica_available {replica_stats['available']}",
+                  "# TYPE petstash_db_replica_lag_seconds gauge", f"petstash_db_replica_lag_seconds {replica_stats['lag_seconds']}",
+                  "# TYPE petstash_db_replica_failures_total counter", f"petstash_db_replica_failures_total {replica_stats['failures']}",
+                  "# TYPE petstash_db_replica_fallbacks_total counter", f"petstash_db_replica_fallbacks_total {replica_stats['fallbacks']}"]
+    return "\n".join(lines) + "\n", 200, {"Content-Type": "text/plain; version=0.0.4"}
 
 
 @app.route('/logout')
@@ -449,57 +1982,138 @@ def logout():
 # GET ALL CATEGORIES -- Return all categories that are active
 @app.route('/store/get-categories')
 def front_get_all_categories():
-    cur = mysql.connection.cursor()
-    result = cur.execute("SELECT * FROM shop_categories WHERE shop_category_display = 1")
-    categories = cur.fetchall()
-    cur.close()
-    return jsonify(categories)
+    catalog = catalog_cache.get()
+    if catalog is not None:
+        return catalog_response(catalog, "categories", catalog["categories"])
+    return jsonify(category_table.active())
+
+
+PRODUCT_CURSOR_TYPES = (decimal.Decimal, int)
+
+
+def product_cursor(product):
+    return [product["shop_product_price"], product["id"]]
+
+
+def catalog_page(catalog, limit, after, fields):
+    # the cached catalog is in (price, id) order already, so a page is a bisect and a slice
+    start = bisect.bisect_right(catalog["keys"], tuple(after)) if after else 0
+    end = start + limit + 1 if limit else len(catalog["products"])
+    return project(catalog["products"][start:end], fields)
+
+
+def products_query(limit, after, fields):
+    # -> (query, params) for a page of active products when the catalog isn't cached
+    query = "SELECT " + (", ".join(fields) if fields else "*") + " FROM shop_products WHERE shop_product_display = 1"
+    params = []
+    if after:
+        query += " AND (shop_product_price > %s OR (shop_product_price = %s AND id > %s))"
+        params = [after[0], after[0], after[1]]
+    query += " ORDER BY shop_product_price, id"
+    if limit:
+        query += " LIMIT %s"
+        params.append(limit + 1)
+    return query, params
 
 
 # GET ALL PRODUCTS -- Return all products that are active, sort from least to most expensive
 @app.route('/store/get-products')
 def front_get_all_products():
-    cur = mysql.connection.cursor()
-    result = cur.execute("SELECT * FROM shop_products WHERE shop_product_display = 1 ORDER BY shop_product_price")
-    products = cur.fetchall()
-    cur.close()
-    return jsonify(products)
+    limit, after = page_args(PRODUCT_CURSOR_TYPES)
+    fields = fields_arg(PRODUCT_FIELDS, ("id", "shop_product_price"))
+    catalog = catalog_cache.get()
+    if catalog is not None:
+        if limit is None and after is None and fields is None and response_format() == "json":
+            return catalog_response(catalog, "products", catalog["products"])
+        return paged_response(catalog_page(catalog, limit, after, fields), limit, product_cursor)
+    query, params = products_query(limit, after, fields)
+    if not limit:
+        return streamed_response(query, params)
+    with db_cursor(replica=True) as cur:
+        result = cur.execute(query, params)
+        products = cur.fetchall()
+    return paged_response(products, limit, product_cursor)
+
+
+def category_not_found():
+    return {"errorText": "Category not found."}, 404
 
 
 # GET PRODUCTS BY CATEGORY  -- Returns all products in the category that are active, using the category URL route -- category assumed active already
 @app.route('/store/get-products/<string:route>')
 def front_get_products_by_category(route):
-    cur = mysql.connection.cursor()
-    result = cur.execute("SELECT * FROM shop_categories WHERE shop_category_route = %s",[route])
-    category = cur.fetchone()
+    catalog = catalog_cache.get()
+    if catalog is not None:
+        if route not in catalog["by_route"]:
+            return category_not_found()
+        return catalog_response(catalog, ("route", route), catalog["by_route"][route])
+    category = category_table.by_route(route)
+    if category is None:
+        return category_not_found()
     category_id = category["shop_category_id"]
-    result = cur.execute("""SELECT * FROM shop_products
-                            WHERE shop_product_display = 1
-                            AND shop_product_category_id = %s
-                            ORDER BY shop_product_price""",[category_id])
-    products = cur.fetchall()
-    cur.close()
+    with db_cursor(replica=True) as cur:
+        result = cur.execute("""SELECT * FROM shop_products
+                                WHERE shop_product_display = 1
+                                AND shop_product_category_id = %s
+                                ORDER BY shop_product_price""",[category_id])
+        products = cur.fetchall()
     return jsonify(products)
 
 
+def with_cart_qty(products, quantities):
+    # adds the product_cart_qty the shop_cart join gives us
+    return [dict(product, product_cart_qty=quantities.get(product["id"], 0)) for product in products]
+
+
+def cart_catalog_response(catalog, products, quantities):
+    # A cached product list with the user's cart quantities overlaid. Every product is encoded once per catalog version
+    # with product_cart_qty 0, so a request only encodes the few products in the cart and joins the rest.
+    if app.config['JSONIFY_PRETTYPRINT_REGULAR'] or app.debug:
+        return jsonify(with_cart_qty(products, quantities))
+    fragments = catalog["payloads"].get("cart_fragments")
+    if fragments is None:
+        fragments = {product["id"]: dumps_json(dict(product, product_cart_qty=0)).rstrip() for product in catalog["products"]}
+        catalog["payloads"]["cart_fragments"] = fragments
+    rows = [fragments[product["id"]] if product["id"] not in quantities
+            else dumps_json(dict(product, product_cart_qty=quantities[product["id"]])).rstrip()
+            for product in products]
+    if response_format() == "ndjson":
+        return app.response_class(b"".join(row + b"\n" for row in rows), mimetype=NDJSON_MIMETYPE)
+    return app.response_class(b"[" + b",".join(rows) + b"]\n", mimetype=app.config['JSONIFY_MIMETYPE'])
+
+
 # GET PRODUCTS BY CATEGORY WITH USER CART  -- Same as above, except it also grabs the amount of each product the current session user has in their cart.
 @app.route('/store/get-products/user/<string:route>')
 def front_get_products_by_category_with_cart(route):
-    cur = mysql.connection.cursor()
     user_id = session['user_id']
-    result = cur.execute("SELECT * FROM shop_categories WHERE shop_category_route = %s",[route])
-    category = cur.fetchone()
+    catalog = catalog_cache.get()
+    if catalog is not None:
+        if route not in catalog["by_route"]:
+            return category_not_found()
+        return cart_catalog_response(catalog, catalog["by_route"][route], cart_store.quantities(user_id))
+    category = category_table.by_route(route)
+    if category is None:
+        return category_not_found()
     category_id = category["shop_category_id"]
-    result = cur.execute("""SELECT p.*, IFNULL(c.cart_qty, 0) as product_cart_qty
-                            FROM shop_products p
-                            LEFT JOIN shop_cart c
-                            ON c.cart_product_id = p.id
-                            AND c.cart_user_id = %s
-                            WHERE p.shop_product_display = 1
-                            AND p.shop_product_category_id = %s
-                            ORDER BY shop_product_price""",(user_id,category_id))
-    products = cur.fetchall()
-    cur.close()
+    if cart_store.write_behind:
+        quantities = cart_store.quantities(user_id)
+        with db_cursor(replica=True) as cur:
+            result = cur.execute("""SELECT * FROM shop_products
+                                    WHERE shop_product_display = 1
+                                    AND shop_product_category_id = %s
+                                    ORDER BY shop_product_price""", [category_id])
+            products = cur.fetchall()
+        return jsonify(with_cart_qty(products, quantities))
+    with db_cursor(replica=True) as cur:
+        result = cur.execute("""SELECT p.*, IFNULL(c.cart_qty, 0) as product_cart_qty
+                                FROM shop_products p
+                                LEFT JOIN shop_cart c
+                                ON c.cart_product_id = p.id
+                                AND c.cart_user_id = %s
+                                WHERE p.shop_product_display = 1
+                                AND p.shop_product_category_id = %s
+                                ORDER BY shop_product_price""",(user_id,category_id))
+        products = cur.fetchall()
     return jsonify(products)
 
 
@@ -507,61 +2121,301 @@ def front_get_products_by_category_with_cart(route):
 # GET ALL PRODUCTS WITH USER CART -- Return all products that are active, and with all cart item quantities for the user in session
 @app.route('/store/get-products/user')
 def front_get_all_products_with_cart():
-    cur = mysql.connection.cursor()
     user_id = session['user_id']
-    result = cur.execute("""SELECT p.*, IFNULL(c.cart_qty, 0) as product_cart_qty
-                            FROM shop_products p
-                            LEFT JOIN shop_cart c
-                            ON c.cart_product_id = p.id
-                            AND c.cart_user_id = %s
-                            WHERE p.shop_product_display = 1
-                            ORDER BY shop_product_price""",[user_id])
-    products = cur.fetchall()
-    cur.close()
-    return jsonify(products)
+    catalog = catalog_cache.get()
+    if catalog is not None:
+        return cart_catalog_response(catalog, catalog["products"], cart_store.quantities(user_id))
+    if cart_store.write_behind:
+        quantities = cart_store.quantities(user_id)
+        return streamed_response("""SELECT * FROM shop_products
+                                    WHERE shop_product_display = 1
+                                    ORDER BY shop_product_price""", [],
+                                 lambda products: with_cart_qty(products, quantities))
+    return streamed_response("""SELECT p.*, IFNULL(c.cart_qty, 0) as product_cart_qty
+                                FROM shop_products p
+                                LEFT JOIN shop_cart c
+                                ON c.cart_product_id = p.id
+                                AND c.cart_user_id = %s
+                                WHERE p.shop_product_display = 1
+                                ORDER BY shop_product_price""",[user_id])
+
+
+
+
+# Product search -- an inverted index over the active products' name, brand and description, kept in each worker.
+# product_add, product_edit and /inventory update it in place; the product import drops it, and the TTL bounds how stale
+# the other workers get (same as the catalog). Every query word has to match a term exactly or as a prefix.
+SEARCH_FIELD_BOOSTS = (("shop_product_name", 3.0), ("shop_product_brand", 2.0), ("shop_product_description", 1.0))
+SEARCH_PREFIX_WEIGHT = 0.5 # a prefix match scores this fraction of an exact one
+SEARCH_PREFIX_TERMS_MAX = 50 # terms a single query word can expand to
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_TOKEN = re.compile(r"\w+")
+SEARCH_PRODUCTS_QUERY = "SELECT * FROM shop_products WHERE shop_product_display = 1"
+
+
+def search_terms(text):
+    return SEARCH_TOKEN.findall(text.casefold()) if text else []
+
+
+class ProductSearchIndex:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.version = 0
+        self._lock = threading.Lock()
+        self._built = threading.Condition(self._lock) # notified when a build finishes
+        self._building = False
+        self._index = None
+        self._loaded_at = 0
+        self._invalidated_at = None
+
+    @staticmethod
+    def _empty():
+        # products: id -> row, postings: term -> {id: weight}, terms: every term, sorted for the prefix lookups
+        return {"products": {}, "postings": {}, "terms": [], "product_terms": {}}
+
+    @staticmethod
+    def _add(index, product, sorted_terms=True):
+        # sorted_terms=False leaves index["terms"] alone, for _build to sort once at the end
+        weights = {}
+        for field, boost in SEARCH_FIELD_BOOSTS:
+            for term in set(search_terms(product[field])):
+                weights[term] = weights.get(term, 0.0) + boost
+        product_id = product["id"]
+        index["products"][product_id] = product
+        index["product_terms"][product_id] = list(weights)
+        for term, weight in weights.items():
+            postings = index["postings"].get(term)
+            if postings is None:
+                postings = index["postings"][term] = {}
+                if sorted_terms:
+                    bisect.insort(index["terms"], term)
+            postings[product_id] = weight
+
+    @staticmethod
+    def _remove(index, product_id):
+        index["products"].pop(product_id, None)
+        for term in index["product_terms"].pop(product_id, []):
+            postings = index["postings"][term]
+            del postings[product_id]
+            if not postings:
+                del index["postings"][term]
+                del index["terms"][bisect.bisect_left(index["terms"], term)]
+
+    def invalidate(self):
+        with self._lock:
+            self._index = None
+            self.version += 1
+            self._invalidated_at = time.monotonic()
+
+    def refresh(self, product_ids):
+        # re-indexes these products from the primary after a committed change -- hidden or deleted ones drop out
+        product_ids = [int(product_id) for product_id in product_ids]
+        with self._lock:
+            self.version += 1
+            if self._index is None or not product_ids:
+                return
+        with db_cursor() as cur:
+            cur.execute("SELECT * FROM shop_products WHERE id IN (" + ", ".join(["%s"] * len(product_ids)) + ")", product_ids)
+            rows = {row["id"]: row for row in cur.fetchall()}
+        with self._lock:
+            self.version += 1
+            if self._index is None:
+                return
+            for product_id in product_ids:
+                self._remove(self._index, product_id)
+                row = rows.get(product_id)
+                if row is not None and row["shop_product_display"] == 1:
+                    self._add(self._index, row)
+
+    def _build(self, replica):
+        index = self._empty()
+        with db_cursor(server_side=True, replica=replica) as cur:
+            cur.execute(SEARCH_PRODUCTS_QUERY)
+            while True:
+                rows = cur.fetchmany(STREAM_CHUNK_ROWS)
+                if not rows:
+                    break
+                for row in rows:
+                    self._add(index, row, sorted_terms=False)
+        index["terms"] = sorted(index["postings"])
+        return index
+
+    def _store(self, index, version):
+        # call with the lock held -- a refresh that landed during the build may be missing from it, so it's dropped then
+        self._building = False
+        self._built.notify_all()
+        if index is not None and version == self.version:
+            self._index = index
+            self._loaded_at = time.monotonic()
+
+    def _rebuild(self, version, replica):
+        # background rebuild of an expired index, which keeps being served until this one replaces it
+        index = None
+        try:
+            with app.app_context():
+                index = self._build(replica)
+        except Exception:
+            app.logger.exception("Search index rebuild failed")
+        with self._lock:
+            self._store(index, version)
+
+    def _loaded(self):
+        # the index to search, call with the lock held. One build at a time per worker: an expired index is rebuilt in the
+        # background and served meanwhile, only the first load (or one after invalidate) makes searches wait for it.
+        while True:
+            index = self._index
+            if index is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return index
+            if not self._building:
+                self._building = True
+                version = self.version
+                replica = self._invalidated_at is None or time.monotonic() - self._invalidated_at >= REPLICA_CACHE_HOLD_SECONDS
+                if index is not None:
+                    threading.Thread(target=self._rebuild, args=(version, replica), name="search-index-build", daemon=True).start()
+                    return index
+                self._lock.release()
+                built = None
+                try:
+                    built = self._build(replica)
+                finally:
+                    self._lock.acquire()
+                    self._store(built, version)
+                return self._index or built
+            if index is not None:
+                return index
+            self._built.wait()
+
+    def _matches(self, index, word):
+        # {id: weight} for one query word, its best exact or prefix match per product
+        matches = dict(index["postings"].get(word, {}))
+        terms = index["terms"]
+        start = bisect.bisect_right(terms, word)
+        for term in terms[start:start + SEARCH_PREFIX_TERMS_MAX]:
+            if not term.startswith(word):
+                break
+            for product_id, weight in index["postings"][term].items():
+                weight *= SEARCH_PREFIX_WEIGHT
+                if weight > matches.get(product_id, 0.0):
+                    matches[product_id] = weight
+        return matches
+
+    def search(self, query, category=None, min_price=None, max_price=None, limit=SEARCH_DEFAULT_LIMIT):
+        # -> the best limit products, highest score first (then by name)
+        words = list(dict.fromkeys(search_terms(query)))
+        if not words:
+            return []
+        with self._lock:
+            index = self._loaded()
+            scores = None
+            for word in sorted(words, key=lambda word: len(index["postings"].get(word, ()))):
+                matches = self._matches(index, word)
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {product_id: score + matches[product_id] for product_id, score in scores.items() if product_id in matches}
+                if not scores:
+                    return []
+            products = index["products"]
+            results = []
+            for product_id, score in scores.items():
+                product = products[product_id]
+                if category is not None and product["shop_product_category_id"] != category:
+                    continue
+                if min_price is not None and product["shop_product_price"] < min_price:
+                    continue
+                if max_price is not None and product["shop_product_price"] > max_price:
+                    continue
+                results.append((-score, product["shop_product_name"], product_id))
+            results.sort()
+            return [products[product_id] for score, name, product_id in results[:limit]]
+
+
+search_index = ProductSearchIndex(CATALOG_CACHE_TTL)
+
+
+def decimal_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        value = decimal.Decimal(value)
+    except decimal.InvalidOperation:
+        raise InvalidArgument(f"{name} must be a number.")
+    if not value.is_finite(): # NaN and Infinity parse, but can't be compared with prices
+        raise InvalidArgument(f"{name} must be a number.")
+    return value
+
+
+# SEARCH PRODUCTS -- ?q= with optional ?category=<id>, ?min_price=, ?max_price=, ?limit= and ?fields=
+@app.route('/store/search')
+def front_search_products():
+    query = request.args.get('q', '')
+    if not search_terms(query):
+        raise InvalidArgument("q is required.")
+    limit = page_args((), default_limit=SEARCH_DEFAULT_LIMIT)[0] # no paging, just ?limit=
+    fields = fields_arg(PRODUCT_FIELDS, ("id",))
+    category = request.args.get('category')
+    if category:
+        try:
+            category = int(category)
+        except ValueError:
+            raise InvalidArgument("category must be a category id.")
+    else:
+        category = None
+    products = search_index.search(query, category, decimal_arg('min_price'), decimal_arg('max_price'), limit)
+    return jsonify(project(products, fields))
 
 
+USERNAME_TAKEN = "Username already taken. Please try again."
+EMAIL_TAKEN = "Email address already taken. Please try again."
 
 
 @app.route('/store/register-user', methods=["POST"])
 def front_register_user():
 
-    cur = mysql.connection.cursor() 
     username = request.json['username']
     email = request.json['email']
 
-    result = cur.execute("SELECT * FROM shop_users")
-    current_users = cur.fetchall()
-    current_user_list = []
-    current_email_list = []
-    for user in current_users:
-        current_user_list.append(user["user_username"])
-        current_email_list.append(user["user_email"])
+    # comparisons done by MySQL so they follow the column collation, same as the unique keys
+    with db_cursor() as cur:
+        result = cur.execute("""SELECT MAX(user_username = %s) AS username_taken,
+                                MAX(user_email = %s) AS email_taken
+                                FROM shop_users
+                                WHERE user_username = %s OR user_email = %s""", (username, email, username, email))
+        taken = cur.fetchone()
 
-    if username in current_user_list:
+    if taken["username_taken"]:
         return {
             "registerSuccess": False,
-            "errorText": "Username already taken. Please try again."
+            "errorText": USERNAME_TAKEN
         }
-    elif email in current_email_list:
+    elif taken["email_taken"]:
         return {
             "registerSuccess": False,
-            "errorText": "Email address already taken. Please try again."
+            "errorText": EMAIL_TAKEN
         }
     else:
         first_name = request.json['first_name']
         last_name = request.json['last_name']
-        password = sha256_crypt.hash(str(request.json['password']))
-        cur.execute("""INSERT INTO shop_users(
-                    user_first_name,
-                    user_last_name,
-                    user_username,
-                    user_email,
-                    user_password
-                    ) VALUES(%s, %s, %s, %s, %s)""",
-                    (first_name, last_name, username, email, password))
-        mysql.connection.commit()
-        cur.close()
+        password = password_hasher.hash(str(request.json['password']))
+        try:
+            with db_cursor() as cur:
+                cur.execute("""INSERT INTO shop_users(
+                            user_first_name,
+                            user_last_name,
+                            user_username,
+                            user_email,
+                            user_password
+                            ) VALUES(%s, %s, %s, %s, %s)""",
+                            (first_name, last_name, username, email, password))
+        except MySQLdb.IntegrityError as error:
+            # lost a race with another registration -- the key name in the message tells us which one
+            db_session().rollback()
+            return {
+                "registerSuccess": False,
+                "errorText": EMAIL_TAKEN if "uq_shop_users_email" in error.args[-1] else USERNAME_TAKEN
+            }
+        db_session().commit()
         return {
             "registerSuccess": True
         }
@@ -581,12 +2435,17 @@ def front_check_login_status():
 def front_login_user():
     username = request.json['username']
     password_input = request.json['password']
-    cur = mysql.connection.cursor()
-    result = cur.execute("SELECT * FROM shop_users WHERE user_username = %s", [username])
-    if result > 0:
+    with db_cursor() as cur:
+        result = cur.execute("SELECT * FROM shop_users WHERE user_username = %s", [username])
         user = cur.fetchone()
+    if result > 0:
         password = user["user_password"]
-        if sha256_crypt.verify(password_input, password):
+        password_match, new_hash = password_hasher.verify(password_input, password)
+        if password_match:
+            if new_hash:
+                with db_cursor() as cur:
+                    cur.execute("UPDATE shop_users SET user_password = %s WHERE user_id = %s", (new_hash, user["user_id"]))
+                db_session().commit()
             session['user_logged_in'] = True
             session['user_id'] = user["user_id"]
             session['user_username'] = user["user_username"]
@@ -618,54 +2477,422 @@ def front_logout_user():
 
 # }
 
+# Cart storage -- API_CART_STORE picks where the /store/cart-* routes keep carts:
+#   mysql  (default) every change is its own statement and commit against shop_cart
+#   memory carts live in this process and are written behind to shop_cart -- only for a single worker process, each worker would have its own carts
+#   redis  carts live in Redis (API_REDIS_URL) and are written behind to shop_cart by whichever worker flushes first
+# Written-behind changes are flushed every API_CART_FLUSH_INTERVAL seconds, at checkout and at exit. An interval of 0 writes through on every change.
+CART_STORE = os.environ.get('API_CART_STORE', 'mysql')
+CART_FLUSH_INTERVAL = float(os.environ.get('API_CART_FLUSH_INTERVAL', 2))
+CART_STORE_MAX_USERS = int(os.environ.get('API_CART_STORE_MAX_USERS', 100000))
+CART_REDIS_URL = os.environ.get('API_REDIS_URL', 'redis://localhost:6379/0')
+CART_REDIS_TTL = int(os.environ.get('API_CART_REDIS_TTL', 7 * 24 * 3600))
+
+CART_UPSERT = """INSERT INTO shop_cart(
+                    cart_user_id,
+                    cart_product_id,
+                    cart_qty
+                    ) VALUES(%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE cart_qty = cart_qty + VALUES(cart_qty)"""
+CART_SET = """INSERT INTO shop_cart(
+                    cart_user_id,
+                    cart_product_id,
+                    cart_qty
+                    ) VALUES(%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE cart_qty = VALUES(cart_qty)"""
+
+
+def cart_ids(product_id, quantity=None):
+    # JSON bodies and URLs give us ids and quantities as numbers or strings -- the stores key carts by int
+    try:
+        if quantity is None:
+            return int(product_id)
+        return int(product_id), int(quantity)
+    except (TypeError, ValueError):
+        raise InvalidArgument("Invalid product or quantity.")
+
+
+def cart_rows(quantities):
+    # cart-fetch rows for a {product_id: qty} cart, product details from the cached catalog where it has them
+    catalog = catalog_cache.get()
+    by_id = catalog["by_id"] if catalog is not None else {}
+    missing = [product_id for product_id in quantities if product_id not in by_id]
+    products = dict(by_id) if missing else by_id
+    if missing:
+        with db_cursor(replica=True) as cur:
+            cur.execute("""SELECT id, shop_product_name, shop_product_price, shop_product_onhand
+                           FROM shop_products WHERE id IN (""" + ", ".join(["%s"] * len(missing)) + ")", missing)
+            products.update((product["id"], product) for product in cur.fetchall())
+    return [{
+        "cart_item_id": product_id, # carts outside MySQL have no row ids, the product id is just as unique within a cart
+        "product_id": product_id,
+        "shop_product_name": products[product_id]["shop_product_name"],
+        "shop_product_price": products[product_id]["shop_product_price"],
+        "shop_product_onhand": products[product_id]["shop_product_onhand"],
+        "cart_qty": qty
+    } for product_id, qty in quantities.items() if product_id in products]
+
+
+class MySQLCartStore:
+    # shop_cart is the cart, every change commits
+    write_behind = False
+
+    def quantities(self, user_id):
+        # served by the (cart_user_id, cart_product_id) unique key
+        with db_cursor(replica=True) as cur:
+            cur.execute("SELECT cart_product_id, cart_qty FROM shop_cart WHERE cart_user_id = %s", [user_id])
+            return {row["cart_product_id"]: row["cart_qty"] for row in cur.fetchall()}
+
+    def fetch(self, user_id):
+        with db_cursor(replica=True) as cur:
+            cur.execute(CART_FETCH_QUERY, [user_id])
+            return cur.fetchall()
+
+    def add(self, user_id, product_id, quantity):
+        # True for a new cart item, False when it increased an existing one
+        with db_cursor() as cur:
+            result = cur.execute(CART_UPSERT, (user_id, product_id, quantity))
+        db_session().commit()
+        return result == 1 # MySQL reports 1 row for an insert, 2 for an update
+
+    def add_many(self, user_id, items):
+        with db_cursor() as cur:
+            cur.executemany(CART_UPSERT, [(user_id, product_id, quantity) for product_id, quantity in items])
+        db_session().commit()
+
+    def set(self, user_id, product_id, quantity):
+        with db_cursor() as cur:
+            cur.execute("""UPDATE shop_cart
+                            SET cart_qty = %s
+                            WHERE cart_user_id = %s AND cart_product_id = %s""", (quantity, user_id, product_id))
+        db_session().commit()
+
+    def remove(self, user_id, product_id):
+        with db_cursor() as cur:
+            cur.execute("""
+                DELETE FROM shop_cart
+                WHERE cart_user_id = %s AND cart_product_id = %s;
+            """, (user_id, product_id))
+        db_session().commit()
+
+    def clear(self, user_id):
+        with db_cursor() as cur:
+            cur.execute("""
+                DELETE FROM shop_cart
+                WHERE cart_user_id = %s;
+            """, [user_id])
+        db_session().commit()
+
+    def flush(self, user_ids=None):
+        return 0
+
+
+class WriteBehindCartStore:
+    # Carts are read and changed in the store and the changed (user_id, product_id) pairs are remembered as dirty.
+    # flush() writes their current quantities to shop_cart (or deletes the rows for items that are gone) in one commit.
+    write_behind = True
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._flush_lock = threading.Lock() # one flush at a time, so an older snapshot can't commit over a newer one
+        self._flusher = BackgroundFlusher("cart-flusher", "Cart", flush_interval, self.flush)
+        self.stats = {"flushes": 0, "rows_flushed": 0, "flush_errors": 0}
+
+    def fetch(self, user_id):
+        return cart_rows(self.quantities(user_id))
+
+    def load(self, user_id):
+        # a cart the store hasn't seen yet starts from shop_cart, on the primary so a lagging replica can't drop items
+        with db_cursor() as cur:
+            cur.execute("SELECT cart_product_id, cart_qty FROM shop_cart WHERE cart_user_id = %s ORDER BY cart_item_id", [user_id])
+            return {row["cart_product_id"]: row["cart_qty"] for row in cur.fetchall()}
+
+    def changed(self, user_id):
+        # after every change: write through when there's no flush interval, else make sure the flusher is running
+        if self.flush_interval <= 0:
+            self.flush([user_id])
+        else:
+            self._flusher.start()
+
+    def flush(self, user_ids=None):
+        # -> number of cart rows written; user_ids limits it to those users' carts
+        # the snapshot is taken and committed under _flush_lock -- two overlapping flushes could otherwise commit out of order
+        with self._flush_lock:
+            pending = self.take_dirty(user_ids)
+            if not pending:
+                return 0
+            try:
+                present = [(user_id, product_id, qty) for user_id, product_id, qty in pending if qty is not None]
+                gone = [(user_id, product_id) for user_id, product_id, qty in pending if qty is None]
+                with db_cursor() as cur:
+                    if present:
+                        cur.executemany(CART_SET, present)
+                    for start in range(0, len(gone), BATCH_UPDATE_SIZE):
+                        chunk = gone[start:start + BATCH_UPDATE_SIZE]
+                        cur.execute("DELETE FROM shop_cart WHERE (cart_user_id, cart_product_id) IN (" +
+                                    ", ".join(["(%s, %s)"] * len(chunk)) + ")", [value for pair in chunk for value in pair])
+                db_session().commit()
+            except Exception:
+                # put them back, the next flush writes whatever the quantities are by then
+                self.mark_dirty([(user_id, product_id) for user_id, product_id, qty in pending])
+                self.stats["flush_errors"] += 1
+                raise
+            self.flushed(pending)
+            self.stats["flushes"] += 1
+            self.stats["rows_flushed"] += len(pending)
+            return len(pending)
+
+    def flushed(self, pending):
+        # after a flush commits -- a store shared between processes re-checks what it wrote, see RedisCartStore
+        pass
+
+
+class MemoryCartStore(WriteBehindCartStore):
+    # carts in a dict, least recently used first; clean carts past max_users are dropped (and reloaded from shop_cart if they come back)
+    def __init__(self, flush_interval, max_users):
+        super().__init__(flush_interval)
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._carts = collections.OrderedDict()
+        self._dirty = {} # user_id -> set of product ids
+
+    @contextlib.contextmanager
+    def _locked_cart(self, user_id):
+        # "with self._locked_cart(user_id) as cart:" -- the user's cart, loaded if needed, with the store lock held
+        while True:
+            with self._lock:
+                cart = self._carts.get(user_id)
+                if cart is not None:
+                    self._carts.move_to_end(user_id)
+                    yield cart
+                    return
+            loaded = self.load(user_id)
+            with self._lock:
+                if user_id not in self._carts:
+                    self._carts[user_id] = loaded
+                    self._evict(user_id)
+
+    def _evict(self, keep):
+        for user_id in list(self._carts):
+            if len(self._carts) <= self.max_users:
+                break
+            if user_id != keep and user_id not in self._dirty:
+                del self._carts[user_id]
+
+    def _touch(self, user_id, product_ids):
+        self._dirty.setdefault(user_id, set()).update(product_ids)
+
+    def quantities(self, user_id):
+        with self._locked_cart(user_id) as cart:
+            return dict(cart)
+
+    def add(self, user_id, product_id, quantity):
+        with self._locked_cart(user_id) as cart:
+            created = product_id not in cart
+            cart[product_id] = cart.get(product_id, 0) + quantity
+            self._touch(user_id, [product_id])
+        self.changed(user_id)
+        return created
+
+    def add_many(self, user_id, items):
+        with self._locked_cart(user_id) as cart:
+            for product_id, quantity in items:
+                cart[product_id] = cart.get(product_id, 0) + quantity
+            self._touch(user_id, [product_id for product_id, quantity in items])
+        self.changed(user_id)
+
+    def set(self, user_id, product_id, quantity):
+        # like the UPDATE it replaces, only changes an item that's already in the cart
+        with self._locked_cart(user_id) as cart:
+            if product_id not in cart:
+                return
+            cart[product_id] = quantity
+            self._touch(user_id, [product_id])
+        self.changed(user_id)
+
+    def remove(self, user_id, product_id):
+        with self._locked_cart(user_id) as cart:
+            if cart.pop(product_id, None) is None:
+                return
+            self._touch(user_id, [product_id])
+        self.changed(user_id)
+
+    def clear(self, user_id):
+        with self._locked_cart(user_id) as cart:
+            self._touch(user_id, list(cart))
+            cart.clear()
+        self.changed(user_id)
+
+    def take_dirty(self, user_ids=None):
+        # -> [(user_id, product_id, qty or None if it's no longer in the cart)]
+        with self._lock:
+            users = list(self._dirty) if user_ids is None else [user_id for user_id in user_ids if user_id in self._dirty]
+            pending = []
+            for user_id in users:
+                cart = self._carts.get(user_id, {})
+                pending += [(user_id, product_id, cart.get(product_id)) for product_id in self._dirty.pop(user_id)]
+            return pending
+
+    def mark_dirty(self, pairs):
+        with self._lock:
+            for user_id, product_id in pairs:
+                self._touch(user_id, [product_id])
+
+
+class RedisCartStore(WriteBehindCartStore):
+    # one hash per cart (product id -> qty, plus a "_" field so an empty cart isn't mistaken for one never loaded)
+    # and one set of dirty "user:product" pairs shared by every worker
+    def __init__(self, flush_interval, url, ttl):
+        super().__init__(flush_interval)
+        if redis is None:
+            raise RuntimeError("API_CART_STORE=redis needs the redis package installed.")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.dirty_key = "petstash:cart:dirty"
+
+    def _key(self, user_id):
+        return f"petstash:cart:{user_id}"
+
+    def _ensure_loaded(self, user_id):
+        key = self._key(user_id)
+        if not self.client.exists(key):
+            # HSETNX so a change another worker made while we were loading isn't overwritten
+            pipe = self.client.pipeline()
+            for product_id, qty in self.load(user_id).items():
+                pipe.hsetnx(key, product_id, qty)
+            pipe.hsetnx(key, "_", 1)
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+        return key
+
+    def quantities(self, user_id):
+        cart = self.client.hgetall(self._ensure_loaded(user_id))
+        return {int(product_id): int(qty) for product_id, qty in cart.items() if product_id != b"_"}
+
+    def _change(self, user_id, product_ids, commands):
+        # runs commands(pipe, key) in a MULTI with the dirty marks and the TTL refresh -> the commands' results
+        key = self._ensure_loaded(user_id)
+        pipe = self.client.pipeline()
+        commands(pipe, key)
+        if product_ids:
+            pipe.sadd(self.dirty_key, *[f"{user_id}:{product_id}" for product_id in product_ids])
+        pipe.expire(key, self.ttl)
+        results = pipe.execute()
+        self.changed(user_id)
+        return results
+
+    def add(self, user_id, product_id, quantity):
+        results = self._change(user_id, [product_id], lambda pipe, key: (pipe.hexists(key, product_id), pipe.hincrby(key, product_id, quantity)))
+        return not results[0]
+
+    def add_many(self, user_id, items):
+        def commands(pipe, key):
+            for product_id, quantity in items:
+                pipe.hincrby(key, product_id, quantity)
+        self._change(user_id, [product_id for product_id, quantity in items], commands)
+
+    def set(self, user_id, product_id, quantity):
+        # HSET only if the field exists, same as the UPDATE it replaces
+        key = self._ensure_loaded(user_id)
+        if self.client.hexists(key, product_id):
+            self._change(user_id, [product_id], lambda pipe, key: pipe.hset(key, product_id, quantity))
+
+    def remove(self, user_id, product_id):
+        self._change(user_id, [product_id], lambda pipe, key: pipe.hdel(key, product_id))
+
+    def clear(self, user_id):
+        product_ids = list(self.quantities(user_id))
+        self._change(user_id, product_ids, lambda pipe, key: (pipe.delete(key), pipe.hset(key, "_", 1)))
+
+    def take_dirty(self, user_ids=None):
+        if user_ids is None:
+            members = self.client.spop(self.dirty_key, 10000) or []
+        else:
+            prefixes = tuple(f"{user_id}:".encode("ascii") for user_id in user_ids)
+            members = [member for member in self.client.smembers(self.dirty_key) if member.startswith(prefixes)]
+            if members:
+                self.client.srem(self.dirty_key, *members)
+        pairs = [tuple(int(part) for part in member.split(b":")) for member in members]
+        pipe = self.client.pipeline(transaction=False)
+        for user_id, product_id in pairs:
+            pipe.hget(self._key(user_id), product_id)
+        return [(user_id, product_id, int(qty) if qty is not None else None)
+                for (user_id, product_id), qty in zip(pairs, pipe.execute())]
+
+    def mark_dirty(self, pairs):
+        if pairs:
+            self.client.sadd(self.dirty_key, *[f"{user_id}:{product_id}" for user_id, product_id in pairs])
+
+    def flushed(self, pending):
+        # _flush_lock only covers this process: another worker can flush a newer quantity for the same pair and commit
+        # before this flush does, leaving shop_cart at the older one. Any pair whose quantity no longer matches what was
+        # just committed is marked dirty again, so the next flush writes the current value.
+        # A cart whose hash has expired is left alone, shop_cart is its copy from then on.
+        pipe = self.client.pipeline(transaction=False)
+        for user_id, product_id, qty in pending:
+            pipe.exists(self._key(user_id))
+            pipe.hget(self._key(user_id), product_id)
+        results = pipe.execute()
+        stale = []
+        for (user_id, product_id, qty), exists, current in zip(pending, results[::2], results[1::2]):
+            if exists and (int(current) if current is not None else None) != qty:
+                stale.append((user_id, product_id))
+        self.mark_dirty(stale)
+
+
+def make_cart_store():
+    if CART_STORE == 'memory':
+        return MemoryCartStore(CART_FLUSH_INTERVAL, CART_STORE_MAX_USERS)
+    if CART_STORE == 'redis':
+        return RedisCartStore(CART_FLUSH_INTERVAL, CART_REDIS_URL, CART_REDIS_TTL)
+    return MySQLCartStore()
+
+
+cart_store = make_cart_store()
+
+
 # Will either create a new cart item for the user, or will detect a cart item with the same product value and increase the quantity by the specified amount
 @app.route('/store/cart-add', methods=["POST"])
 def front_cart_add_product():
     user_id = session['user_id']
-    product_id = request.json['product_id']
-    quantity = request.json['quantity']
-    cur = mysql.connection.cursor()
-    result = cur.execute("SELECT * FROM shop_cart WHERE cart_user_id = %s AND cart_product_id = %s", (user_id, product_id))
-    if result > 0:
-        current_item = cur.fetchone()
-        current_quantity = current_item["cart_qty"]
-        new_quantity = quantity + current_quantity
-        cur.execute("""UPDATE shop_cart
-                        SET cart_qty = %s
-                        WHERE cart_user_id = %s AND cart_product_id = %s""", (new_quantity, user_id, product_id))
-        mysql.connection.commit()
-        cur.close()
-        return {
-            "cartChangeSuccess": True,
-            "cartUpdate": True
-        }
-    else:
-        cur.execute("""INSERT INTO shop_cart(
-                    cart_user_id,
-                    cart_product_id,
-                    cart_qty
-                    ) VALUES(%s, %s, %s)""",
-                    (user_id, product_id, quantity))
-        mysql.connection.commit()
-        cur.close()
+    product_id, quantity = cart_ids(request.json['product_id'], request.json['quantity'])
+    if cart_store.add(user_id, product_id, quantity):
         return {
             "cartChangeSuccess": True,
             "cartAdd": True
         }
+    return {
+        "cartChangeSuccess": True,
+        "cartUpdate": True
+    }
+
+
+# {
+#     items: [{
+#         product_id: X,
+#         quantity: X
+#     },]
+# }
+
+# Same as cart-add for a list of items, in one round trip
+@app.route('/store/cart-add-many', methods=["POST"])
+def front_cart_add_many():
+    user_id = session['user_id']
+    items = [cart_ids(item['product_id'], item['quantity']) for item in request.json['items']]
+    if items:
+        cart_store.add_many(user_id, items)
+    return {
+        "cartChangeSuccess": True,
+        "cartItemCount": len(items)
+    }
 
 
 #Modify the quantity value of a cart item instead of increasing it
 @app.route('/store/cart-modify', methods=["POST"])
 def front_cart_modify_product():
     user_id = session['user_id']
-    product_id = request.json['product_id']
-    quantity = request.json['quantity']
-    cur = mysql.connection.cursor()
-    cur.execute("""UPDATE shop_cart
-                    SET cart_qty = %s
-                    WHERE cart_user_id = %s AND cart_product_id = %s""", (quantity, user_id, product_id))
-    mysql.connection.commit()
-    cur.close()
+    product_id, quantity = cart_ids(request.json['product_id'], request.json['quantity'])
+    cart_store.set(user_id, product_id, quantity)
     return {
         "cartChangeSuccess": True,
         "cartUpdate": True
@@ -673,37 +2900,30 @@ def front_cart_modify_product():
 
 
 # Grab all cart items relevant to the user in session
+CART_FETCH_QUERY = """
+                SELECT c.cart_item_id,
+                    p.id AS product_id,
+                    p.shop_product_name,
+                    p.shop_product_price,
+                    p.shop_product_onhand,
+                    c.cart_qty 
+                    FROM shop_cart c
+                    JOIN shop_products p
+                    ON c.cart_product_id = p.id
+                    WHERE c.cart_user_id = %s;"""
+
+
 @app.route('/store/cart-fetch')
 def front_cart_fetch():
-    cur = mysql.connection.cursor()
     user_id = session['user_id']
-    result = cur.execute("""
-            SELECT c.cart_item_id,
-                p.id AS product_id,
-                p.shop_product_name,
-                p.shop_product_price,
-                p.shop_product_onhand,
-                c.cart_qty 
-                FROM shop_cart c
-                JOIN shop_products p
-                ON c.cart_product_id = p.id
-                WHERE c.cart_user_id = %s;""",[user_id])
-    cart_products = cur.fetchall()
-    cur.close()
-    return jsonify(cart_products)
+    return jsonify(cart_store.fetch(user_id))
 
 
 # Delete all cart items associated with the user
 @app.route('/store/cart-delete-all',methods=["DELETE"])
 def front_cart_delete_all():
-    cur = mysql.connection.cursor()
     user_id = session['user_id']
-    result = cur.execute("""
-        DELETE FROM shop_cart
-        WHERE cart_user_id = %s;
-    """, [user_id])
-    mysql.connection.commit()
-    cur.close()
+    cart_store.clear(user_id)
     return {
         "cartChangeSuccess": True,
         "cartDelete": True
@@ -713,14 +2933,8 @@ def front_cart_delete_all():
 # Delete only the user's cart item with the given product ID.
 @app.route('/store/cart-delete/<string:product_id>',methods=["DELETE"])
 def front_cart_delete(product_id):
-    cur = mysql.connection.cursor()
     user_id = session['user_id']
-    result = cur.execute("""
-        DELETE FROM shop_cart
-        WHERE cart_user_id = %s AND cart_product_id = %s;
-    """, (user_id, product_id))
-    mysql.connection.commit()
-    cur.close()
+    cart_store.remove(user_id, cart_ids(product_id))
     return {
         "cartChangeSuccess": True,
         "cartDelete": True
@@ -729,30 +2943,28 @@ def front_cart_delete(product_id):
 # Grab all information associated with the user account in session
 @app.route('/store/user')
 def front_get_user():
-    cur = mysql.connection.cursor()
     user_id = session['user_id']
-    result = cur.execute("SELECT * FROM shop_users WHERE user_id = %s",[user_id])
-    user_info = cur.fetchone()
-    cur.close()
+    with db_cursor(replica=True) as cur:
+        result = cur.execute("SELECT * FROM shop_users WHERE user_id = %s",[user_id])
+        user_info = cur.fetchone()
     return user_info
 
 # Update user address
 @app.route('/store/user/address', methods=["POST"])
 def front_user_address_update():
-    cur = mysql.connection.cursor()
     user_id = session['user_id']
     address = request.json['address']
     city = request.json['city']
     state = request.json['state']
     zipcode = request.json['zipcode']
-    cur.execute("""UPDATE shop_users
-                    SET user_address = %s,
-                    user_city = %s,
-                    user_state = %s,
-                    user_zip = %s
-                    WHERE user_id = %s""", (address, city, state, zipcode, user_id))
-    mysql.connection.commit()
-    cur.close()
+    with db_cursor() as cur:
+        cur.execute("""UPDATE shop_users
+                        SET user_address = %s,
+                        user_city = %s,
+                        user_state = %s,
+                        user_zip = %s
+                        WHERE user_id = %s""", (address, city, state, zipcode, user_id))
+    db_session().commit()
     return {
         "addressChangeSuccess": True
     }
@@ -768,15 +2980,22 @@ def front_user_address_update():
 #     }
 #     products: [{
 #         product_id:
-#         product_price:
+#         product_price: (ignored, prices come from shop_products)
 #         product_qty:
 #     },]
 # }
 
+def transaction_failed(error_text, status=400):
+    return {
+        "transactionSuccess": False,
+        "errorText": error_text
+    }, status
+
+
 # Create transaction -- passes in the shipping info and products list -- generates a transaction summary and transaction product items associated with it
+# Everything runs in one DB transaction: the products are locked and priced from shop_products, the summary and items are inserted and the on hand counts come down together.
 @app.route('/store/transaction/create', methods=["POST"])
 def front_transaction_create():
-    cur = mysql.connection.cursor()
     user_id = session['user_id']
     product_list = request.json['products']
     shipping_info = request.json['shipping']
@@ -786,38 +3005,59 @@ def front_transaction_create():
     state = shipping_info['state']
     zipcode = shipping_info['zipcode']
 
-    transaction_cost = 0
-    for product in product_list:
-        transaction_cost += product['product_price'] * product['product_qty']
-
-    result = cur.execute("""INSERT INTO shop_transaction(
-                                transaction_user_id,
-                                transaction_cost,
-                                transaction_city,
-                                transaction_zipcode,
-                                transaction_state,
-                                transaction_address
-                                ) VALUES(%s, %s, %s, %s, %s, %s)""",
-                                (user_id, transaction_cost, city, zipcode, state, address))
-    mysql.connection.commit()
-
-    result = cur.execute("SELECT transaction_id from shop_transaction WHERE transaction_user_id = %s ORDER BY transaction_date DESC",[user_id])
-    transaction_created = cur.fetchone()
-    transaction_id = transaction_created["transaction_id"]
+    quantities = {} # product id -> qty, repeated lines are merged
     for product in product_list:
-        product_id = product['product_id']
         product_qty = product['product_qty']
-        result =  cur.execute("""INSERT INTO shop_trans_item(
-                    trans_item_product_id,
-                    trans_item_transaction_id,
-                    trans_item_qty
-                    ) VALUES(%s, %s, %s)""",
-                    (product_id, transaction_id, product_qty))
-        mysql.connection.commit()
-    mysql.connection.commit()
-    cur.close()
+        if not isinstance(product_qty, int) or isinstance(product_qty, bool) or product_qty < 1:
+            return transaction_failed("Invalid product quantity.")
+        try:
+            product_id = int(product['product_id'])
+        except (TypeError, ValueError):
+            return transaction_failed("Invalid product.")
+        quantities[product_id] = quantities.get(product_id, 0) + product_qty
+    if not quantities:
+        return transaction_failed("No products in order.")
+    product_ids = list(quantities)
+    id_placeholders = ", ".join(["%s"] * len(product_ids))
+    cart_store.flush([user_id]) # shop_cart is up to date for this user's cart from here on
+
+    with db_cursor() as cur:
+        result = cur.execute("SELECT id, shop_product_price, shop_product_onhand FROM shop_products WHERE id IN (" + id_placeholders + ") FOR UPDATE", product_ids)
+        products = {product['id']: product for product in cur.fetchall()}
+        if len(products) < len(product_ids):
+            db_session().rollback()
+            return transaction_failed("Product not found.")
+        if any(products[product_id]['shop_product_onhand'] < qty for product_id, qty in quantities.items()):
+            db_session().rollback()
+            return transaction_failed("Not enough stock to fill the order.", 409)
+
+        transaction_cost = sum(products[product_id]['shop_product_price'] * qty for product_id, qty in quantities.items())
+        result = cur.execute("""INSERT INTO shop_transaction(
+                                    transaction_user_id,
+                                    transaction_cost,
+                                    transaction_city,
+                                    transaction_zipcode,
+                                    transaction_state,
+                                    transaction_address
+                                    ) VALUES(%s, %s, %s, %s, %s, %s)""",
+                                    (user_id, transaction_cost, city, zipcode, state, address))
+        transaction_id = cur.lastrowid
+        cur.executemany("""INSERT INTO shop_trans_item(
+                        trans_item_product_id,
+                        trans_item_transaction_id,
+                        trans_item_qty
+                        ) VALUES(%s, %s, %s)""",
+                        [(product_id, transaction_id, qty) for product_id, qty in quantities.items()])
+        case_sql, params = case_by_id(quantities)
+        cur.execute("UPDATE shop_products SET shop_product_onhand = shop_product_onhand - " + case_sql +
+                    " WHERE id IN (" + id_placeholders + ")", params + product_ids)
+    db_session().commit()
+    # the cached catalog (and the cart rows built from it) and the search index carry shop_product_onhand
+    catalog_cache.invalidate()
+    search_index.refresh(product_ids)
     return {
-        "transactionSuccess": True
+        "transactionSuccess": True,
+        "transactionId": transaction_id
     }
 
 
@@ -825,39 +3065,60 @@ def front_transaction_create():
 # A single transaction by id
 @app.route('/store/transaction/get/<string:trans_id>')
 def front_get_transaction_by_id(trans_id):
-    cur = mysql.connection.cursor()
-    result = cur.execute("""SELECT * from shop_transaction
-                            WHERE transaction_id = %s""",[trans_id])
-    transaction = cur.fetchone()
-    cur.close()
+    with db_cursor(replica=True) as cur:
+        result = cur.execute("""SELECT * from shop_transaction
+                                WHERE transaction_id = %s""",[trans_id])
+        transaction = cur.fetchone()
     return transaction
 
 
+TRANSACTION_CURSOR_TYPES = (datetime.datetime.fromisoformat, int)
+
+
+def transaction_cursor(transaction):
+    return [transaction["transaction_date"], transaction["transaction_id"]]
+
+
+def transactions_query(user_id, limit, after, fields):
+    # -> (query, params) for a page of the user's transactions, newest first
+    query = "SELECT " + (", ".join(fields) if fields else "*") + " FROM shop_transaction WHERE transaction_user_id = %s"
+    params = [user_id]
+    if after:
+        query += " AND (transaction_date < %s OR (transaction_date = %s AND transaction_id < %s))"
+        params += [after[0], after[0], after[1]]
+    query += " ORDER BY transaction_date DESC, transaction_id DESC"
+    if limit:
+        query += " LIMIT %s"
+        params.append(limit + 1)
+    return query, params
+
+
 # Get all transactions for user in session
 @app.route('/store/transactions')
 def front_get_transactions_by_user():
-    cur = mysql.connection.cursor()
     user_id = session['user_id']
-    result = cur.execute("""SELECT * from shop_transaction
-                            WHERE transaction_user_id = %s
-                            ORDER BY transaction_date DESC""",[user_id])
-    transactions = cur.fetchall()
-    cur.close()
-    return jsonify(transactions)
+    limit, after = page_args(TRANSACTION_CURSOR_TYPES)
+    fields = fields_arg(TRANSACTION_FIELDS, ("transaction_id", "transaction_date"))
+    query, params = transactions_query(user_id, limit, after, fields)
+    if not limit:
+        return streamed_response(query, params)
+    with db_cursor(replica=True) as cur:
+        result = cur.execute(query, params)
+        transactions = cur.fetchall()
+    return paged_response(transactions, limit, transaction_cursor)
 
 
 # Get transaction items from transaction id
 @app.route('/store/transaction/items/<string:trans_id>')
 def front_get_trans_items_by_id(trans_id):
-    cur = mysql.connection.cursor()
-    result = cur.execute("""
-                SELECT p.id, p.shop_product_name, t.trans_item_qty, p.shop_product_price
-                FROM shop_trans_item t
-                JOIN shop_products p
-                ON p.id = t.trans_item_product_id
-                WHERE t.trans_item_transaction_id = %s""",[trans_id])
-    trans_items = cur.fetchall()
-    cur.close()
+    with db_cursor(replica=True) as cur:
+        result = cur.execute("""
+                    SELECT p.id, p.shop_product_name, t.trans_item_qty, p.shop_product_price
+                    FROM shop_trans_item t
+                    JOIN shop_products p
+                    ON p.id = t.trans_item_product_id
+                    WHERE t.trans_item_transaction_id = %s""",[trans_id])
+        trans_items = cur.fetchall()
     return jsonify(trans_items)
 
 # TODO: CHECK ANY DECIMAL DATA --- IT MAY NEED TO BE SENT BACK AS A STRING AND CONVERTED INTO A DECIMAL AFTERWARDS. CANNOT USE AS JSON DATA, ENCODER OVERRIDE HOPEFULLY FIXES THIS.
@@ -0,0 +1,297 @@
+# Asyncio serving mode -- the read-heavy storefront endpoints run on an event loop against an aiomysql pool,
+# so a request waiting on MySQL doesn't hold a whole worker.
+#
+#   gunicorn async_app:application --worker-class aiohttp.GunicornWebWorker
+#
+# /store/get-products, /store/get-categories, /store/cart-fetch and /store/transactions are served here, sharing the
+# catalog cache, query builders and JSON encoding with app.py. Everything else (the admin views, login, cart writes,
+# checkout) is handed to the Flask app through aiohttp-wsgi, which runs it on a thread pool.
+# The default entry point (gunicorn app:app with gthread workers, see the Procfile) is unchanged.
+# With API_REPLICA_HOST set, reads go to the replica under the same health, backoff and read-your-writes rules as app.py.
+import asyncio
+import concurrent.futures
+import os
+import time
+
+import aiomysql
+import pymysql
+from aiohttp import web
+from aiohttp_wsgi import WSGIHandler
+from itsdangerous import BadSignature
+
+import app as api
+
+ASYNC_POOL_SIZE = int(os.environ.get('API_ASYNC_POOL_SIZE', api.app.config['MYSQL_POOL_SIZE']))
+WSGI_THREADS = int(os.environ.get('API_WSGI_THREADS', 8))
+CORS_EXPOSE_HEADERS = "X-Next-Cursor"
+# for an oversized catalog -- api.category_table loads through the blocking driver, so it isn't used on the event loop
+ACTIVE_CATEGORIES_QUERY = "SELECT * FROM shop_categories WHERE shop_category_display = 1"
+
+
+def create_pool(replica=False):
+    config = api.app.config
+    return aiomysql.create_pool(
+        host=config['MYSQL_REPLICA_HOST'] if replica else config['MYSQL_HOST'],
+        port=config['MYSQL_REPLICA_PORT'] if replica else config['MYSQL_PORT'],
+        user=config['MYSQL_USER'],
+        password=config['MYSQL_PASSWORD'] or "",
+        db=config['MYSQL_DB'],
+        charset=config['MYSQL_CHARSET'],
+        cursorclass=aiomysql.DictCursor,
+        autocommit=True,
+        minsize=0 if replica else 1, # a replica that's down at startup just isn't used yet
+        maxsize=ASYNC_POOL_SIZE,
+        pool_recycle=config['MYSQL_POOL_MAX_LIFETIME'])
+
+
+async def open_pool(application):
+    application["db_pool"] = await create_pool()
+    application["replica_pool"] = await create_pool(replica=True) if api.mysql.has_replica else None
+    application["catalog_lock"] = asyncio.Lock()
+
+
+async def close_pool(application):
+    for name in ("db_pool", "replica_pool"):
+        if application[name] is not None:
+            application[name].close()
+            await application[name].wait_closed()
+
+
+def replica_unreachable(error):
+    return isinstance(error, pymysql.err.OperationalError) and error.args[0] in api.REPLICA_CONNECTION_ERRORS
+
+
+async def read_pools(request, replica=True):
+    # the pools to try in order -- the replica first when it's usable and this session hasn't written lately (DBSession.replica_connection)
+    primary, replica_pool = request.app["db_pool"], request.app["replica_pool"]
+    if not replica or replica_pool is None:
+        return [primary]
+    if time.time() - flask_session(request).get('db_last_write', 0) < api.REPLICA_STICKY_SECONDS:
+        return [primary]
+    health = api.mysql.replica_health
+    if not health.available():
+        health.fell_back()
+        return [primary]
+    if health.check_due():
+        try:
+            async with replica_pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute("SHOW SLAVE STATUS")
+                    status = await cur.fetchone()
+        except pymysql.err.OperationalError as error:
+            if replica_unreachable(error):
+                health.failed()
+                health.fell_back()
+                return [primary]
+            status = None # no REPLICATION CLIENT privilege
+        if not health.lag_ok(status):
+            health.failed()
+            health.fell_back()
+            return [primary]
+        health.succeeded()
+    return [replica_pool, primary]
+
+
+async def fetchall(request, query, params=None, replica=True):
+    pools = await read_pools(request, replica)
+    for pool in pools:
+        try:
+            async with pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(query, params)
+                    return await cur.fetchall()
+        except pymysql.err.OperationalError as error:
+            if pool is pools[-1] or not replica_unreachable(error):
+                raise
+            api.mysql.replica_health.failed()
+            api.mysql.replica_health.fell_back()
+
+
+def flask_session(request):
+    # reads the signed Flask session cookie the same way SecureCookieSessionInterface does, an empty dict if it's missing or invalid
+    cookie = request.cookies.get(api.app.session_cookie_name)
+    serializer = api.app.session_interface.get_signing_serializer(api.app)
+    if not cookie or serializer is None:
+        return {}
+    try:
+        return serializer.loads(cookie, max_age=int(api.app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+def encoded(fn, *args):
+    # the JSON helpers fall back to the stdlib encoder, which needs the Flask app context for CustomJSONEncoder
+    with api.app.app_context():
+        return fn(*args)
+
+
+async def get_catalog(request):
+    # catalog_cache.get() on the event loop -- one coroutine loads it, the others wait for that load
+    catalog = api.catalog_cache.peek()
+    if catalog is None:
+        async with request.app["catalog_lock"]:
+            catalog = api.catalog_cache.peek()
+            if catalog is None:
+                version = api.catalog_cache.version
+                replica = api.catalog_cache.replica_ok()
+                categories = await fetchall(request, api.CATALOG_CATEGORIES_QUERY, replica=replica)
+                products = await fetchall(request, api.CATALOG_PRODUCTS_QUERY, [api.catalog_cache.max_size + 1], replica=replica)
+                catalog = api.build_catalog(categories, list(products))
+                api.catalog_cache.store(catalog, version)
+    if catalog.get("oversized") or len(catalog["products"]) > api.catalog_cache.max_size:
+        return None
+    return catalog
+
+
+def etag_matches(request, etag):
+    # If-None-Match uses the weak comparison, like werkzeug's make_conditional
+    for tag in request.headers.get("If-None-Match", "").split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == "*" or (tag and tag.strip('"') == etag):
+            return True
+    return False
+
+
+def catalog_response(request, catalog, key, data):
+    # same headers and 304 handling as api.catalog_response
+    payload = encoded(api.catalog_payload, catalog, key, data)
+    headers = {"Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if "gzip" in payload and "gzip" in request.headers.get("Accept-Encoding", ""):
+        body, etag = payload["gzip"], payload["etag"] + "-gz"
+        headers["Content-Encoding"] = "gzip"
+    else:
+        body, etag = payload["body"], payload["etag"]
+    headers["ETag"] = f'"{etag}"'
+    if etag_matches(request, etag):
+        headers.pop("Content-Encoding", None)
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, headers=headers, content_type=api.app.config['JSONIFY_MIMETYPE'])
+
+
+def json_response(data, status=200):
+    return web.Response(body=encoded(api.dumps_json, data), status=status, content_type=api.app.config['JSONIFY_MIMETYPE'])
+
+
+def paged_response(rows, limit, cursor_of, fmt):
+    body, mimetype, next_cursor = encoded(api.paged_body, rows, limit, cursor_of, fmt)
+    response = web.Response(body=body, content_type=mimetype)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+
+async def streamed_response(request, query, params, fmt):
+    # api.streamed_response on an unbuffered aiomysql cursor
+    ndjson = fmt == "ndjson"
+    response = web.StreamResponse()
+    response.content_type = api.NDJSON_MIMETYPE if ndjson else api.app.config['JSONIFY_MIMETYPE']
+    pools = await read_pools(request)
+    pool = pools[0]
+    try:
+        conn = await pool.acquire()
+    except pymysql.err.OperationalError as error:
+        if len(pools) == 1 or not replica_unreachable(error):
+            raise
+        api.mysql.replica_health.failed()
+        api.mysql.replica_health.fell_back()
+        pool = pools[-1]
+        conn = await pool.acquire()
+    try:
+        async with conn.cursor(aiomysql.SSDictCursor) as cur:
+            await cur.execute(query, params)
+            await response.prepare(request)
+            if not ndjson:
+                await response.write(b"[")
+            first = True
+            while True:
+                rows = await cur.fetchmany(api.STREAM_CHUNK_ROWS)
+                if not rows:
+                    break
+                await response.write(encoded(api.encode_chunk, rows, ndjson, first))
+                first = False
+    finally:
+        pool.release(conn)
+    if not ndjson:
+        await response.write(b"]\n")
+    await response.write_eof()
+    return response
+
+
+async def get_categories(request):
+    catalog = await get_catalog(request)
+    if catalog is not None:
+        return catalog_response(request, catalog, "categories", catalog["categories"])
+    return json_response(await fetchall(request, ACTIVE_CATEGORIES_QUERY))
+
+
+async def get_products(request):
+    limit, after = api.page_args(api.PRODUCT_CURSOR_TYPES, args=request.query)
+    fields = api.fields_arg(api.PRODUCT_FIELDS, ("id", "shop_product_price"), args=request.query)
+    fmt = api.response_format(request.query)
+    catalog = await get_catalog(request)
+    if catalog is not None:
+        if limit is None and after is None and fields is None and fmt == "json":
+            return catalog_response(request, catalog, "products", catalog["products"])
+        return paged_response(api.catalog_page(catalog, limit, after, fields), limit, api.product_cursor, fmt)
+    query, params = api.products_query(limit, after, fields)
+    if not limit:
+        return await streamed_response(request, query, params, fmt)
+    return paged_response(await fetchall(request, query, params), limit, api.product_cursor, fmt)
+
+
+async def cart_fetch(request):
+    user_id = flask_session(request)['user_id']
+    return json_response(await fetchall(request, api.CART_FETCH_QUERY, [user_id]))
+
+
+async def get_transactions(request):
+    user_id = flask_session(request)['user_id']
+    limit, after = api.page_args(api.TRANSACTION_CURSOR_TYPES, args=request.query)
+    fields = api.fields_arg(api.TRANSACTION_FIELDS, ("transaction_id", "transaction_date"), args=request.query)
+    fmt = api.response_format(request.query)
+    query, params = api.transactions_query(user_id, limit, after, fields)
+    if not limit:
+        return await streamed_response(request, query, params, fmt)
+    return paged_response(await fetchall(request, query, params), limit, api.transaction_cursor, fmt)
+
+
+@web.middleware
+async def invalid_argument(request, handler):
+    try:
+        return await handler(request)
+    except api.InvalidArgument as error:
+        return json_response({"errorText": str(error)}, 400)
+
+
+async def add_cors_headers(request, response):
+    # what flask_cors adds to the Flask responses (supports_credentials, X-Next-Cursor exposed) -- those already have them
+    origin = request.headers.get("Origin")
+    if origin and "Access-Control-Allow-Origin" not in response.headers:
+        response.headers["Access-Control-Allow-Origin"] = origin
+        response.headers["Access-Control-Allow-Credentials"] = "true"
+        response.headers["Access-Control-Expose-Headers"] = CORS_EXPOSE_HEADERS
+        response.headers.add("Vary", "Origin")
+
+
+def make_app():
+    application = web.Application(middlewares=[invalid_argument])
+    application.on_startup.append(open_pool)
+    application.on_cleanup.append(close_pool)
+    application.on_response_prepare.append(add_cors_headers)
+    application.router.add_get('/store/get-categories', get_categories)
+    application.router.add_get('/store/get-products', get_products)
+    if not api.cart_store.write_behind: # carts kept outside MySQL are read through the Flask app's cart store
+        application.router.add_get('/store/cart-fetch', cart_fetch)
+    application.router.add_get('/store/transactions', get_transactions)
+    wsgi_handler = WSGIHandler(api.app, executor=concurrent.futures.ThreadPoolExecutor(WSGI_THREADS))
+    application.router.add_route("*", "/{path_info:.*}", wsgi_handler)
+    return application
+
+
+application = make_app()
+
+
+if __name__ == "__main__":
+    web.run_app(application, port=int(os.environ.get('PORT', 5000)))
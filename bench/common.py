@@ -0,0 +1,45 @@
+# Shared helpers for the benchmark scripts -- latency summaries and the JSON results files.
+import datetime
+import json
+import os
+import platform
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def summarize_latencies(latencies):
+    # latencies in seconds -> summary in milliseconds
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3) if values else 0.0
+    }
+
+
+def write_results(path, kind, config, results):
+    report = {
+        "kind": kind,
+        "started_at": datetime.datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "config": config,
+        "results": results
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(f"Wrote {path}")
+    return report
+
+
+def print_table(results, columns):
+    print("  ".join(["name".ljust(32)] + [column.rjust(10) for column in columns]))
+    for name, result in sorted(results.items()):
+        print("  ".join([name.ljust(32)] + [str(result.get(column, "")).rjust(10) for column in columns]))
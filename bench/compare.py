@@ -0,0 +1,46 @@
+# Compares two results files written by bench.load or bench.micro, e.g. before and after a change.
+#
+#   python -m bench.compare baseline.json candidate.json
+import argparse
+import json
+
+COLUMNS = ("rps", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "errors")
+
+
+def change(before, after):
+    if not before:
+        return ""
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark results files.")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline["kind"] != candidate["kind"]:
+        raise SystemExit(f"Can't compare a {baseline['kind']} run with a {candidate['kind']} run.")
+    ignored = ("label",)
+    if ({k: v for k, v in baseline["config"].items() if k not in ignored} !=
+            {k: v for k, v in candidate["config"].items() if k not in ignored}):
+        print("Warning: the runs used different configs")
+
+    print("  ".join(["name".ljust(32), "metric".ljust(8), "baseline".rjust(12), "candidate".rjust(12), "change".rjust(9)]))
+    for name in sorted(set(baseline["results"]) | set(candidate["results"])):
+        before = baseline["results"].get(name, {})
+        after = candidate["results"].get(name, {})
+        for column in COLUMNS:
+            if column not in before and column not in after:
+                continue
+            old, new = before.get(column, 0), after.get(column, 0)
+            print("  ".join([name.ljust(32), column.ljust(8), str(old).rjust(12), str(new).rjust(12),
+                             change(old, new).rjust(9)]))
+
+
+if __name__ == "__main__":
+    main()
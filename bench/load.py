@@ -0,0 +1,138 @@
+# Drives the /store/* endpoints of a running API with concurrent clients and reports throughput and latency percentiles.
+#
+#   python -m bench.seed --products 5000 --users 200
+#   API_DB=petstash_bench gunicorn app:app --workers 4 --worker-class gthread --threads 8
+#   python -m bench.load --url http://localhost:8000 --concurrency 32 --duration 30 --out load.json
+#
+# To compare the serving modes, run the same load against each entry point with the same worker count and --label them:
+#   gunicorn app:app --workers 2 --worker-class gthread --threads 8                (--label threaded)
+#   gunicorn async_app:application --workers 2 --worker-class aiohttp.GunicornWebWorker  (--label async)
+#
+# Each client logs in as one of the seeded bench users and picks endpoints from a weighted mix, with a fixed random
+# seed per client so runs are repeatable. Results are written as JSON for bench.compare.
+import argparse
+import http.cookiejar
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from bench.common import print_table, summarize_latencies, write_results
+from bench.seed import BENCH_PASSWORD
+
+# name -> (weight, method, path, body) -- {route} and {product_id} are filled in per request
+SCENARIO = {
+    "get-products": (30, "GET", "/store/get-products", None),
+    "get-categories": (15, "GET", "/store/get-categories", None),
+    "get-products-by-category": (20, "GET", "/store/get-products/{route}", None),
+    "get-products-with-cart": (10, "GET", "/store/get-products/user", None),
+    "cart-fetch": (10, "GET", "/store/cart-fetch", None),
+    "cart-add": (10, "POST", "/store/cart-add", {"product_id": "{product_id}", "quantity": 1}),
+    "transaction-create": (5, "POST", "/store/transaction/create", {
+        "shipping": {"address": "1 Bench St", "city": "Bench", "state": "TX", "zipcode": "00000"},
+        "products": [{"product_id": "{product_id}", "product_qty": 1}]
+    })
+}
+
+
+class Client:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                     headers={"Content-Type": "application/json"} if data else {})
+        try:
+            with self.opener.open(req, timeout=30) as response:
+                payload = response.read()
+                return response.status, payload
+        except urllib.error.HTTPError as error:
+            return error.code, error.read()
+
+
+def fill(value, values):
+    if isinstance(value, dict):
+        return {key: fill(item, values) for key, item in value.items()}
+    if isinstance(value, list):
+        return [fill(item, values) for item in value]
+    if isinstance(value, str) and value.startswith("{") and value.endswith("}"):
+        return values[value[1:-1]]
+    if isinstance(value, str):
+        return value.format(**values)
+    return value
+
+
+def worker(index, args, routes, product_ids, deadline, results, lock):
+    rng = random.Random(args.seed * 1000 + index)
+    client = Client(args.url)
+    client.request("POST", "/store/login", {"username": f"bench{index % args.users}", "password": BENCH_PASSWORD})
+    names = list(SCENARIO)
+    weights = [SCENARIO[name][0] for name in names]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    while time.monotonic() < deadline:
+        name = rng.choices(names, weights)[0]
+        weight, method, path, body = SCENARIO[name]
+        values = {"route": rng.choice(routes), "product_id": rng.choice(product_ids)}
+        start = time.perf_counter()
+        status, payload = client.request(method, fill(path, values), fill(body, values))
+        latencies[name].append(time.perf_counter() - start)
+        if status >= 400:
+            errors[name] += 1
+    with lock:
+        for name in names:
+            results[name]["latencies"] += latencies[name]
+            results[name]["errors"] += errors[name]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the storefront endpoints.")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--users", type=int, default=200, help="number of seeded bench users to log in as")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", default="", help="free-form name for the server setup, e.g. sync or async")
+    parser.add_argument("--out", default="bench_load.json")
+    args = parser.parse_args()
+
+    client = Client(args.url)
+    status, payload = client.request("GET", "/store/get-categories")
+    routes = [category["shop_category_route"] for category in json.loads(payload)]
+    status, payload = client.request("GET", "/store/get-products?fields=id&limit=500")
+    product_ids = [product["id"] for product in json.loads(payload)]
+    if not routes or not product_ids:
+        raise SystemExit("No categories or products found -- seed the database with bench.seed first.")
+
+    results = {name: {"latencies": [], "errors": 0} for name in SCENARIO}
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(i, args, routes, product_ids, deadline, results, lock))
+               for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    report = {}
+    all_latencies = []
+    for name, result in results.items():
+        all_latencies += result["latencies"]
+        report[name] = dict(summarize_latencies(result["latencies"]), errors=result["errors"],
+                            rps=round(len(result["latencies"]) / elapsed, 2))
+    report["total"] = dict(summarize_latencies(all_latencies), errors=sum(r["errors"] for r in results.values()),
+                           rps=round(len(all_latencies) / elapsed, 2))
+    print_table(report, ["rps", "p50_ms", "p95_ms", "p99_ms", "errors"])
+    write_results(args.out, "load", {"url": args.url, "concurrency": args.concurrency, "duration": args.duration,
+                                     "users": args.users, "seed": args.seed,
+                                     "label": args.label}, report)
+
+
+if __name__ == "__main__":
+    main()
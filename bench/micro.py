@@ -0,0 +1,104 @@
+# In-process micro-benchmarks for the CPU-bound pieces of a request: JSON encoding of the catalog, the inventory
+# page and password hashing. No database or server is needed.
+#
+#   python -m bench.micro --products 10000 --out micro.json
+import argparse
+import decimal
+import random
+import timeit
+
+from passlib.hash import sha256_crypt
+
+import app as api
+from bench.common import print_table, summarize_latencies, write_results
+
+
+def fake_products(count, seed_value):
+    rng = random.Random(seed_value)
+    return [{
+        "id": i,
+        "shop_product_name": f"Product {i}",
+        "shop_product_brand": f"Brand {rng.randint(1, 50)}",
+        "shop_product_price": decimal.Decimal(rng.randint(100, 100000)) / 100,
+        "shop_product_image_url": f"https://example.com/{i}.png",
+        "shop_product_description": "A product used for benchmarking. " * 4,
+        "shop_product_category_id": rng.randint(1, 20),
+        "shop_product_display": 1,
+        "shop_product_onhand": rng.randint(0, 1000)
+    } for i in range(1, count + 1)]
+
+
+def measure(fn, repeat):
+    # one warm-up call, then a timing per call
+    fn()
+    return summarize_latencies(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def bench_json(products, repeat):
+    # the same payload through each JSON backend dumps_json can use
+    results = {}
+    backends = ["json", "orjson"] if api.orjson is not None else ["json"]
+    default_backend = api.JSON_BACKEND
+    try:
+        with api.app.app_context():
+            for backend in backends:
+                api.JSON_BACKEND = backend
+                results[f"json-products-{backend}"] = measure(lambda: api.dumps_json(products), repeat)
+    finally:
+        api.JSON_BACKEND = default_backend
+    for name, result in results.items():
+        result["payloads_per_sec"] = round(1000 / result["mean_ms"], 2) if result["mean_ms"] else 0.0
+    return results
+
+
+def bench_inventory(products, repeat):
+    # one /inventory page: rendering it from plain rows, and reading back a POST where a single count changed
+    page = products[:api.ADMIN_PAGE_SIZE]
+    form_data = {}
+    for product in page:
+        form_data[f"was-{product['id']}"] = str(product["shop_product_onhand"])
+        form_data[f"onhand-{product['id']}"] = str(product["shop_product_onhand"])
+    form_data[f"onhand-{page[0]['id']}"] = str(page[0]["shop_product_onhand"] + 1)
+
+    def render():
+        with api.app.test_request_context("/inventory"):
+            api.render_template("inventory.html", products=page, next_cursor="x", categories=[(1, "Dogs")], category=None)
+
+    def deltas():
+        with api.app.test_request_context("/inventory", method="POST", data=form_data):
+            api.inventory_deltas(api.request.form)
+    return {"inventory-render": measure(render, repeat), "inventory-deltas": measure(deltas, repeat)}
+
+
+def bench_hashing(rounds, repeat):
+    hashed = sha256_crypt.using(rounds=rounds).hash("benchpass")
+    return {
+        "hash": measure(lambda: sha256_crypt.using(rounds=rounds).hash("benchpass"), repeat),
+        "verify": measure(lambda: sha256_crypt.verify("benchpass", hashed), repeat)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run in-process micro-benchmarks.")
+    parser.add_argument("--products", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default="bench_micro.json")
+    args = parser.parse_args()
+
+    products = fake_products(args.products, args.seed)
+    rounds = api.PASSWORD_HASH_ROUNDS
+    hashing = bench_hashing(rounds, min(args.repeat, 10))
+    results = bench_json(products, args.repeat)
+    results.update(bench_inventory(products, args.repeat))
+    results.update({
+        "password-hash": hashing["hash"],
+        "password-verify": hashing["verify"]
+    })
+    print_table(results, ["count", "mean_ms", "p50_ms", "p95_ms", "max_ms", "payloads_per_sec"])
+    write_results(args.out, "micro", {"products": args.products, "repeat": args.repeat,
+                                      "hash_rounds": rounds, "json_backend": api.JSON_BACKEND}, results)
+
+
+if __name__ == "__main__":
+    main()
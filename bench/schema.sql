@@ -0,0 +1,81 @@
+-- Tables the PetStash API expects, for seeding a local benchmark database.
+-- bench.seed applies this file and then everything in migrations/ in order.
+
+CREATE TABLE admin_user (
+    admin_user_id INT AUTO_INCREMENT PRIMARY KEY,
+    admin_user_firstname VARCHAR(45) NOT NULL,
+    admin_user_lastname VARCHAR(45) NOT NULL,
+    admin_user_employee_id VARCHAR(45) NOT NULL,
+    admin_user_username VARCHAR(25) NOT NULL,
+    admin_user_password VARCHAR(100) NOT NULL
+);
+
+CREATE TABLE admin_updatelog (
+    admin_updatelog_id INT AUTO_INCREMENT PRIMARY KEY,
+    admin_updatelog_log VARCHAR(255) NOT NULL,
+    admin_updatelog_admin_id INT,
+    admin_updatelog_admin VARCHAR(45),
+    admin_updatelog_timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE shop_categories (
+    shop_category_id INT AUTO_INCREMENT PRIMARY KEY,
+    shop_category_name VARCHAR(45) NOT NULL,
+    shop_category_display TINYINT NOT NULL DEFAULT 1,
+    shop_category_route VARCHAR(19) NOT NULL,
+    shop_category_icon_url VARCHAR(100),
+    shop_category_banner_url VARCHAR(100),
+    shop_category_banner_display TINYINT NOT NULL DEFAULT 0,
+    shop_category_banner_button VARCHAR(45),
+    shop_category_banner_caption VARCHAR(150)
+);
+
+CREATE TABLE shop_products (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    shop_product_name VARCHAR(100) NOT NULL,
+    shop_product_brand VARCHAR(45) NOT NULL,
+    shop_product_price DECIMAL(10, 2) NOT NULL,
+    shop_product_image_url VARCHAR(100),
+    shop_product_description VARCHAR(255),
+    shop_product_category_id INT,
+    shop_product_display TINYINT NOT NULL DEFAULT 1,
+    shop_product_onhand INT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE shop_users (
+    user_id INT AUTO_INCREMENT PRIMARY KEY,
+    user_first_name VARCHAR(45),
+    user_last_name VARCHAR(45),
+    user_username VARCHAR(45) NOT NULL,
+    user_email VARCHAR(100) NOT NULL,
+    user_password VARCHAR(100) NOT NULL,
+    user_address VARCHAR(100),
+    user_city VARCHAR(45),
+    user_state VARCHAR(45),
+    user_zip VARCHAR(10)
+);
+
+CREATE TABLE shop_cart (
+    cart_item_id INT AUTO_INCREMENT PRIMARY KEY,
+    cart_user_id INT NOT NULL,
+    cart_product_id INT NOT NULL,
+    cart_qty INT NOT NULL
+);
+
+CREATE TABLE shop_transaction (
+    transaction_id INT AUTO_INCREMENT PRIMARY KEY,
+    transaction_user_id INT NOT NULL,
+    transaction_cost DECIMAL(10, 2) NOT NULL,
+    transaction_date DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    transaction_address VARCHAR(100),
+    transaction_city VARCHAR(45),
+    transaction_state VARCHAR(45),
+    transaction_zipcode VARCHAR(10)
+);
+
+CREATE TABLE shop_trans_item (
+    trans_item_id INT AUTO_INCREMENT PRIMARY KEY,
+    trans_item_product_id INT NOT NULL,
+    trans_item_transaction_id INT NOT NULL,
+    trans_item_qty INT NOT NULL
+);
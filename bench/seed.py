@@ -0,0 +1,93 @@
+# Seeds a local MySQL database for the load benchmark.
+#
+#   python -m bench.seed --products 5000 --users 200 --cart-items 5
+#
+# Connection settings come from the same API_HOST / API_USER / API_PASSWORD variables as the app, the database
+# name from BENCH_DB (default petstash_bench). The database is dropped and rebuilt from bench/schema.sql plus
+# migrations/, so never point BENCH_DB at real data. Every seeded user is bench<N> with password BENCH_PASSWORD.
+import argparse
+import glob
+import os
+import random
+
+import MySQLdb
+from dotenv import load_dotenv
+from passlib.hash import sha256_crypt
+
+BENCH_PASSWORD = "benchpass"
+BATCH_SIZE = 1000
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def sql_statements(path):
+    with open(path) as f:
+        lines = [line for line in f if not line.strip().startswith("--")]
+    return [statement.strip() for statement in "".join(lines).split(";") if statement.strip()]
+
+
+def insert_batches(cur, query, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        cur.executemany(query, rows[start:start + BATCH_SIZE])
+
+
+def seed(conn, categories, products, users, cart_items, seed_value):
+    rng = random.Random(seed_value)
+    cur = conn.cursor()
+    insert_batches(cur, """INSERT INTO shop_categories(
+                            shop_category_name, shop_category_display, shop_category_route
+                            ) VALUES(%s, %s, %s)""",
+                   [(f"Category {i}", 1, f"category-{i}") for i in range(1, categories + 1)])
+    insert_batches(cur, """INSERT INTO shop_products(
+                            shop_product_name, shop_product_brand, shop_product_price, shop_product_image_url,
+                            shop_product_description, shop_product_category_id, shop_product_display, shop_product_onhand
+                            ) VALUES(%s, %s, %s, %s, %s, %s, %s, %s)""",
+                   [(f"Product {i}", f"Brand {rng.randint(1, 50)}", f"{rng.uniform(1, 500):.2f}", f"https://example.com/{i}.png",
+                     "Benchmark product " * 10, rng.randint(1, categories), 1 if rng.random() < 0.9 else 0, 100000)
+                    for i in range(1, products + 1)])
+    password = sha256_crypt.hash(BENCH_PASSWORD) # hashed once, every bench user shares it
+    insert_batches(cur, """INSERT INTO shop_users(
+                            user_first_name, user_last_name, user_username, user_email, user_password
+                            ) VALUES(%s, %s, %s, %s, %s)""",
+                   [("Bench", f"User {i}", f"bench{i}", f"bench{i}@example.com", password) for i in range(users)])
+    cart_rows = []
+    for user_id in range(1, users + 1):
+        for product_id in rng.sample(range(1, products + 1), min(cart_items, products)):
+            cart_rows.append((user_id, product_id, rng.randint(1, 3)))
+    insert_batches(cur, "INSERT INTO shop_cart(cart_user_id, cart_product_id, cart_qty) VALUES(%s, %s, %s)", cart_rows)
+    conn.commit()
+    cur.close()
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Seed a local benchmark database.")
+    parser.add_argument("--categories", type=int, default=10)
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--cart-items", type=int, default=5, help="cart rows per user")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    database = os.environ.get("BENCH_DB", "petstash_bench")
+    kwargs = {"host": os.environ.get("API_HOST") or "localhost", "charset": "utf8"}
+    if os.environ.get("API_USER"):
+        kwargs["user"] = os.environ["API_USER"]
+    if os.environ.get("API_PASSWORD"):
+        kwargs["passwd"] = os.environ["API_PASSWORD"]
+    conn = MySQLdb.connect(**kwargs)
+    cur = conn.cursor()
+    cur.execute(f"DROP DATABASE IF EXISTS `{database}`")
+    cur.execute(f"CREATE DATABASE `{database}`")
+    cur.execute(f"USE `{database}`")
+    for path in [os.path.join(HERE, "schema.sql")] + sorted(glob.glob(os.path.join(HERE, "..", "migrations", "*.sql"))):
+        for statement in sql_statements(path):
+            cur.execute(statement)
+    cur.close()
+    seed(conn, args.categories, args.products, args.users, args.cart_items, args.seed)
+    conn.close()
+    print(f"Seeded {database}: {args.categories} categories, {args.products} products, {args.users} users, "
+          f"{args.users * args.cart_items} cart rows. Run the API with API_DB={database}.")
+
+
+if __name__ == "__main__":
+    main()
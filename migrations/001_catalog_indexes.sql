@@ -0,0 +1,8 @@
+-- Indexes for the storefront catalog queries:
+--   category pages resolve shop_category_route, then list active products in the category by price.
+
+CREATE INDEX idx_shop_categories_route ON shop_categories (shop_category_route);
+
+CREATE INDEX idx_shop_products_display ON shop_products (shop_product_display);
+
+CREATE INDEX idx_shop_products_category_price ON shop_products (shop_product_category_id, shop_product_price);
@@ -0,0 +1,7 @@
+-- Indexes backing keyset pagination:
+--   /store/get-products walks active products by (shop_product_price, id),
+--   /store/transactions walks a user's orders by (transaction_date, transaction_id).
+
+CREATE INDEX idx_shop_products_display_price ON shop_products (shop_product_display, shop_product_price, id);
+
+CREATE INDEX idx_shop_transaction_user_date ON shop_transaction (transaction_user_id, transaction_date, transaction_id);
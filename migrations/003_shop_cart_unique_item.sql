@@ -0,0 +1,19 @@
+-- One shop_cart row per (user, product) so /store/cart-add can upsert.
+-- Existing duplicates are merged into the oldest row first.
+
+UPDATE shop_cart c
+JOIN (
+    SELECT cart_user_id, cart_product_id, MIN(cart_item_id) AS keep_id, SUM(cart_qty) AS total_qty
+    FROM shop_cart
+    GROUP BY cart_user_id, cart_product_id
+    HAVING COUNT(*) > 1
+) d ON c.cart_item_id = d.keep_id
+SET c.cart_qty = d.total_qty;
+
+DELETE c FROM shop_cart c
+JOIN shop_cart k
+ON k.cart_user_id = c.cart_user_id
+AND k.cart_product_id = c.cart_product_id
+AND k.cart_item_id < c.cart_item_id;
+
+ALTER TABLE shop_cart ADD UNIQUE KEY uq_shop_cart_user_product (cart_user_id, cart_product_id);
@@ -0,0 +1,27 @@
+-- Registration relies on these for its existence checks and to reject concurrent duplicates.
+-- The key names are matched on in front_register_user to tell username and email conflicts apart.
+--
+-- Registration used to check and insert separately, so a live database can already hold duplicates and the
+-- ALTERs below would fail on them. Run these first; each row is a value held by more than one account:
+--
+--   SELECT user_username, COUNT(*), GROUP_CONCAT(user_id ORDER BY user_id) FROM shop_users
+--   GROUP BY user_username HAVING COUNT(*) > 1;
+--   SELECT user_email, COUNT(*), GROUP_CONCAT(user_id ORDER BY user_id) FROM shop_users
+--   GROUP BY user_email HAVING COUNT(*) > 1;
+--   SELECT admin_user_username, COUNT(*), GROUP_CONCAT(admin_user_id ORDER BY admin_user_id) FROM admin_user
+--   GROUP BY admin_user_username HAVING COUNT(*) > 1;
+--
+-- Accounts can't be merged automatically like the cart rows in 003 -- they own carts, transactions and passwords.
+-- Keep the oldest account of each group as it is and rename the later ones, then tell those users their new login, e.g.
+--
+--   UPDATE shop_users u JOIN shop_users k ON k.user_username = u.user_username AND k.user_id < u.user_id
+--   SET u.user_username = CONCAT(u.user_username, '-', u.user_id);
+--
+-- and the same for user_email (or clear it and ask the user for a new one) and admin_user_username
+-- (admin_user_username is VARCHAR(25), so shorten the name if the suffix doesn't fit).
+
+ALTER TABLE shop_users ADD UNIQUE KEY uq_shop_users_username (user_username);
+
+ALTER TABLE shop_users ADD UNIQUE KEY uq_shop_users_email (user_email);
+
+ALTER TABLE admin_user ADD UNIQUE KEY uq_admin_user_username (admin_user_username);
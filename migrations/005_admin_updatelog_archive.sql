@@ -0,0 +1,24 @@
+-- The home feed pages admin_updatelog on (admin_updatelog_timestamp, admin_updatelog_id), newest first.
+-- flask archive-updatelog moves rows past the retention window into admin_updatelog_archive
+-- and counts them per day and admin in admin_updatelog_daily.
+
+ALTER TABLE admin_updatelog ADD INDEX idx_admin_updatelog_timestamp (admin_updatelog_timestamp, admin_updatelog_id);
+
+CREATE TABLE IF NOT EXISTS admin_updatelog_archive (
+    admin_updatelog_id INT NOT NULL PRIMARY KEY,
+    admin_updatelog_log VARCHAR(255) NOT NULL,
+    admin_updatelog_admin_id INT,
+    admin_updatelog_admin VARCHAR(45),
+    admin_updatelog_timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB ROW_FORMAT=COMPRESSED;
+
+-- updatelog_admin_id is 0 for entries without an admin id
+CREATE TABLE IF NOT EXISTS admin_updatelog_daily (
+    updatelog_day DATE NOT NULL,
+    updatelog_admin_id INT NOT NULL,
+    updatelog_admin VARCHAR(45),
+    updatelog_entries INT NOT NULL,
+    updatelog_first TIMESTAMP NULL,
+    updatelog_last TIMESTAMP NULL,
+    PRIMARY KEY (updatelog_day, updatelog_admin_id)
+);
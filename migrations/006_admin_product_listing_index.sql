@@ -0,0 +1,9 @@
+-- The admin /products and /inventory pages walk products by (shop_product_category_id, shop_product_name, id),
+-- see category_keyset in app.py. idx_shop_products_category_price (001) leads with the same column but is ordered by
+-- price after it, so it can't serve that order.
+
+CREATE INDEX idx_shop_products_category_name ON shop_products (shop_product_category_id, shop_product_name, id);
+
+-- idx_shop_products_display (001) is the leading column of idx_shop_products_display_price (002), which serves every
+-- query the narrower one could.
+DROP INDEX idx_shop_products_display ON shop_products;